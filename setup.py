@@ -12,10 +12,8 @@ setup(name='termpdf.py',
       requires=[
           'PyMuPDF', 
           'pyperclip', 
-          'pdfrw', 
           'pybtex', 
           'pynvim', 
-          'roman',
-          'pagelabels'
+          'roman'
           ]
      )
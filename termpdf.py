@@ -30,14 +30,22 @@ Keys:
     gg:             go to beginning of document
     G:              go to end of document
     [count]G:       go to page [count]
+    w:              cycle through fitting pages to the screen, to its width,
+                    and showing them continuously
+    ctrl-d, ctrl-u: scroll down, up half a screen (fit width, continuous)
     b:		    cycle through open documents
     s:              visual mode
     t:              table of contents 
+    o:              page thumbnails
     M:              show metadata
     f:              show links on page
+    /:              search
+    n, N:           go to next, previous match
+    ?:              search all buffers
     r:              rotate [count] quarter turns clockwise
     R:              rotate [count] quarter turns counterclockwise
     c:              toggle autocropping of margins
+    C:              toggle uniform autocropping of odd and even pages
     a:              toggle alpha transparency
     i:              invert colors
     d:              darken using TINT_COLOR
@@ -51,6 +59,7 @@ Keys:
 
 import re
 import array
+import struct
 import curses
 import fcntl
 import fitz
@@ -63,18 +72,26 @@ import subprocess
 import zlib
 import shutil
 import select
+import signal
 import hashlib
 import string
 import json
+import sqlite3
 import roman
 import pyperclip
-from time import sleep, monotonic
+from time import sleep, monotonic, time
 from base64 import standard_b64encode
-from operator import attrgetter
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from math import ceil
+from bisect import bisect_left, bisect_right, insort
 from tempfile import NamedTemporaryFile
 
+try:
+    import numpy
+except ImportError:
+    # only needed for autocropping by pixels and faster page filters
+    numpy = None
+
 
 # Class Definitions
 
@@ -97,6 +114,20 @@ class Config:
         self.URL_BROWSER = None
         self.GUI_VIEWER = 'preview'
         self.NOTE_PATH = os.path.join(os.getenv("HOME"), 'inbox.org')
+        self.PREFETCH_DEPTH = 2 # pages to render ahead in the reading direction
+        self.RENDER_CACHE_SIZE = 256 # megabytes of rendered pages kept in memory
+        self.TRANSFER_MODE = 'auto' # auto, shm, file, or direct
+        self.TERMINAL_IMAGE_BUDGET = 256 # megabytes of page images kept in kitty
+        self.AUTOSAVE_INTERVAL = 30 # seconds between saves of document state
+        self.SEARCH_WORKERS = 0 # processes for searching; 0 picks a number
+        self.SEARCH_LIBRARY = False # whether ? also searches BIBTEX's files
+        self.AUTOCROP_METHOD = 'auto' # auto, text, or pixels
+        self.SCROLL_ROWS = 3 # terminal rows that j and k scroll when fitting width
+        self.PROGRESSIVE_RENDER = 0.2 # seconds a page may take to render before it is previewed; 0 turns previews off
+        self.RENDER_WORKERS = 0 # processes for rendering previewed pages and thumbnails; 0 picks a number
+        self.THUMBNAIL_SIZE = 192 # pixels of the longer side of page thumbnails
+        self.GAMMA = 1.0 # above 1 lightens rendered pages, below 1 darkens them
+        self.CONTRAST = 1.0 # above 1 adds contrast to rendered pages
 
     def browser_detect(self):
         if sys.platform == 'darwin':
@@ -132,6 +163,7 @@ class Buffers:
         self.current = (self.current + count) % len(self.docs)
 
     def close_buffer(self,n):
+        watcher.unwatch(self.docs[n].filename)
         del self.docs[n]
         if self.current == n:
             self.current = max(0,n-1)
@@ -148,6 +180,9 @@ class Screen:
         self.cell_width = 0
         self.cell_height = 0
         self.stdscr = None
+        self.transfer_medium = 'd'
+        # the image last placed, which placing again replaces
+        self.placed = None
 
     def get_size(self):
         fd = sys.stdout
@@ -240,6 +275,58 @@ class Screen:
         sys.stdout.flush()
 
 
+class File_Identity:
+    """
+    Digests that identify files for the state cache, memoized by
+    device, inode, size, and mtime. Large files are identified by
+    their size and a sample of their blocks, rather than read in full.
+    """
+    blocksize = 65536
+    samples = 16
+
+    def __init__(self):
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def stat_key(self, path):
+        st = os.stat(path)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def memoized(self, path, kind, digest):
+        key = (kind,) + self.stat_key(path)
+        with self.lock:
+            value = self.digests.get(key)
+        if value is None:
+            value = digest(path)
+            with self.lock:
+                self.digests[key] = value
+        return value
+
+    def fast_digest(self, path):
+        size = os.path.getsize(path)
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(str(size).encode())
+        with open(path, 'rb') as f:
+            if size <= self.blocksize * self.samples * 2:
+                buf = f.read(self.blocksize)
+                while len(buf) > 0:
+                    hasher.update(buf)
+                    buf = f.read(self.blocksize)
+            else:
+                # the first and last blocks, and evenly spaced ones between
+                step = (size - self.blocksize) // (self.samples - 1)
+                for i in range(self.samples):
+                    f.seek(i * step)
+                    hasher.update(f.read(self.blocksize))
+        return hasher.hexdigest()
+
+    def digest(self, path):
+        return self.memoized(path, 'fast', self.fast_digest)
+
+    def md5(self, path):
+        # the digest older versions of termpdf.py used
+        return self.memoized(path, 'md5', get_filehash)
+
 def get_filehash(path):
     blocksize = 65536
     hasher = hashlib.md5()
@@ -250,35 +337,1366 @@ def get_filehash(path):
             buf = afile.read(blocksize)
     return hasher.hexdigest()
 
-def get_cachefile(path):
-    filehash = get_filehash(path)
+def get_cachedir():
     cachedir = os.path.expanduser(os.path.join(os.getenv("XDG_CACHE_HOME", "~/.cache"), 'termpdf.py'))
     os.makedirs(cachedir, exist_ok=True)
-    cachefile = os.path.join(cachedir, filehash)
-    return cachefile
+    return cachedir
+
+class State_Store:
+    """
+    Document state, kept in a SQLite database in the cache directory.
+    Writes are atomic upserts, so several instances can share it.
+    """
+    def __init__(self):
+        self.conn = None
+        self.lock = threading.RLock()
+        self.saved = {}
+        self.thread = None
+        # whether states saved under MD5 keys may remain
+        self.legacy = True
+
+    def connect(self):
+        with self.lock:
+            if self.conn is None:
+                path = os.path.join(get_cachedir(), 'state.db')
+                conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                                 'key TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                                 'updated REAL NOT NULL)')
+                    conn.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                                 'key TEXT NOT NULL, kind TEXT NOT NULL, '
+                                 'data BLOB NOT NULL, updated REAL NOT NULL, '
+                                 'PRIMARY KEY (key, kind))')
+                self.conn = conn
+                self.migrate()
+            return self.conn
+
+    def migrate(self):
+        # import the JSON state files older versions wrote, once;
+        # version 2 records that no state is left under an MD5 key
+        conn = self.conn
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= 2:
+            self.legacy = False
+            return
+        if version == 1:
+            self.check_legacy()
+            return
+        cachedir = get_cachedir()
+        rows = []
+        for name in os.listdir(cachedir):
+            if not re.fullmatch('[0-9a-f]{32}|[0-9a-f]{40}', name):
+                continue
+            path = os.path.join(cachedir, name)
+            try:
+                with open(path, 'r') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            rows.append((name, json.dumps(state), os.path.getmtime(path)))
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO state (key, state, updated) '
+                             'VALUES (?, ?, ?)', rows)
+            conn.execute('PRAGMA user_version = 1')
+        self.check_legacy()
+
+    def check_legacy(self):
+        # stop looking for MD5 keys, which take reading the whole file
+        # to compute, once the last of them has been moved
+        conn = self.conn
+        if conn.execute('SELECT 1 FROM state WHERE length(key) = 32 LIMIT 1').fetchone():
+            return
+        with conn:
+            conn.execute('PRAGMA user_version = 2')
+        self.legacy = False
+
+    def save_many(self, docs):
+        # save the state of several documents in one transaction
+        rows = []
+        for doc in docs:
+            state = doc.state()
+            try:
+                key = file_identity.digest(doc.filename)
+            except OSError:
+                continue
+            if self.saved.get(key) == state:
+                continue
+            rows.append((key, json.dumps(state), time(), state))
+        if not rows:
+            return
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.executemany('INSERT INTO state (key, state, updated) VALUES (?, ?, ?) '
+                                 'ON CONFLICT(key) DO UPDATE SET '
+                                 'state = excluded.state, updated = excluded.updated',
+                                 [row[:3] for row in rows])
+            for key, _, _, state in rows:
+                self.saved[key] = state
+
+    def save(self, doc):
+        self.save_many([doc])
+
+    def load_many(self, paths):
+        # saved states for several documents, in one query
+        keys = {file_identity.digest(path): path for path in paths}
+        with self.lock:
+            conn = self.connect()
+            query = 'SELECT key, state FROM state WHERE key IN ({})'.format(
+                    ','.join('?' * len(keys)))
+            rows = conn.execute(query, list(keys)).fetchall()
+        states = {}
+        for key, state in rows:
+            states[keys[key]] = json.loads(state)
+            self.saved[key] = states[keys[key]]
+        for key, path in keys.items():
+            if path not in states:
+                state = self.load_legacy(path, key)
+                if state is not None:
+                    states[path] = state
+        return states
+
+    def load(self, path):
+        return self.load_many([path]).get(path)
+
+    def load_legacy(self, path, key):
+        # state saved under the MD5 of the whole file, by older
+        # versions of termpdf.py, moved to its new key
+        with self.lock:
+            self.connect()
+            if not self.legacy:
+                return None
+        legacy = file_identity.md5(path)
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute('SELECT state FROM state WHERE key = ?', (legacy,)).fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO state (key, state, updated) '
+                             'VALUES (?, ?, ?)', (key, row[0], time()))
+                conn.execute('DELETE FROM state WHERE key = ?', (legacy,))
+            self.check_legacy()
+        return json.loads(row[0])
+
+    def rekey(self, old, new):
+        # move state and blobs to the new key of a file we changed,
+        # except its page labels
+        if old == new:
+            return
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('UPDATE OR REPLACE state SET key = ? WHERE key = ?', (new, old))
+                conn.execute("DELETE FROM blobs WHERE key = ? AND kind = 'labels'", (old,))
+                conn.execute('UPDATE OR REPLACE blobs SET key = ? WHERE key = ?', (new, old))
+
+    def replace(self, old, new):
+        # move the state of a file that changed on disk to its new
+        # key, and drop the data derived from the old version, which
+        # would otherwise pile up with every version
+        if old == new:
+            return
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('UPDATE OR IGNORE state SET key = ? WHERE key = ?', (new, old))
+                conn.execute('DELETE FROM state WHERE key = ?', (old,))
+                conn.execute('DELETE FROM blobs WHERE key = ?', (old,))
+            self.saved.pop(old, None)
+
+    def save_blob(self, key, kind, data):
+        # data derived from a document, such as its text index,
+        # stored next to its state
+        with self.lock:
+            conn = self.connect()
+            with conn:
+                conn.execute('INSERT INTO blobs (key, kind, data, updated) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT(key, kind) DO UPDATE SET '
+                             'data = excluded.data, updated = excluded.updated',
+                             (key, kind, zlib.compress(data), time()))
+
+    def load_blob(self, key, kind):
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute('SELECT data FROM blobs WHERE key = ? AND kind = ?',
+                               (key, kind)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0])
+
+    def start_autosave(self):
+        if config.AUTOSAVE_INTERVAL <= 0:
+            return
+        self.thread = threading.Thread(target=self.autosave)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def autosave(self):
+        while True:
+            sleep(config.AUTOSAVE_INTERVAL)
+            try:
+                self.save_many(list(bufs.docs))
+            except Exception:
+                logging.exception('autosave failed')
+
+# a rendered page, ready to be sent to kitty
+Rendered = namedtuple('Rendered', ['width', 'height', 'alpha', 'samples'])
+
+class Render_Cache:
+    """
+    An LRU cache of rendered pages, keyed by everything that affects
+    the pixels, and bounded by a budget in bytes
+    """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def budget(self):
+        return int(config.RENDER_CACHE_SIZE * 1024 * 1024)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        size = len(entry.samples)
+        if size > self.budget():
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= len(old.samples)
+            self.entries[key] = entry
+            self.size += size
+            while self.size > self.budget():
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.samples)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def discard(self, fingerprints):
+        # drop the renders of pages with these fingerprints
+        fingerprints = set(fingerprints)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] in fingerprints]:
+                self.size -= len(self.entries.pop(key).samples)
+
+    def stats(self):
+        return 'render cache: {} pages, {:.1f}/{} MB, {} hits, {} misses, {} evictions'.format(
+                len(self.entries), self.size / (1024 * 1024), config.RENDER_CACHE_SIZE,
+                self.hits, self.misses, self.evictions)
+
+class Color_Filter:
+    """
+    Inverts, tints, and adjusts the gamma and contrast of rendered
+    pages, in place, with one lookup table per color channel
+    """
+    def __init__(self):
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.pixels = 0
+        self.seconds = 0
+
+    def key(self, invert, tint_color):
+        # everything that determines the tables, or None if the filter
+        # would leave the pixels alone
+        key = (invert, tint_color, float(config.GAMMA), float(config.CONTRAST))
+        if key[1:] == (None, 1, 1) and not invert:
+            return None
+        return key
+
+    def get_tables(self, key, channels):
+        tables = self.tables.get((key, channels))
+        if tables is not None:
+            return tables
+        invert, tint_color, gamma, contrast = key
+        if tint_color is None:
+            tint = (1,) * channels
+        else:
+            tint = fitz.utils.getColor(tint_color)
+            if channels < 3:
+                # tint gray pages by the luminance of the color
+                tint = (0.299 * tint[0] + 0.587 * tint[1] + 0.114 * tint[2],) * channels
+        tables = []
+        for c in range(channels):
+            table = bytearray(256)
+            for v in range(256):
+                x = (255 - v if invert else v) / 255
+                x = x ** (1 / gamma) if gamma > 0 else x
+                x = (x - 0.5) * contrast + 0.5
+                x = x * tint[c]
+                table[v] = min(255, max(0, round(x * 255)))
+            tables.append(bytes(table))
+        self.tables[(key, channels)] = tables
+        return tables
+
+    def apply(self, pix, invert, tint_color):
+        # filter pix in place
+        key = self.key(invert, tint_color)
+        if key is None:
+            return
+        start = monotonic()
+        channels = pix.n - pix.alpha
+        tables = self.get_tables(key, channels)
+        samples = pix.samples_mv
+        if not pix.alpha and len(set(tables)) == 1:
+            # one table for every byte, which translate beats numpy at
+            samples[:] = samples.tobytes().translate(tables[0])
+        elif numpy:
+            # a view of the samples, so the tables write straight into pix
+            image = numpy.frombuffer(samples, dtype=numpy.uint8)
+            image = image.reshape(pix.height * pix.width, pix.n)
+            for c, table in enumerate(tables):
+                lut = numpy.frombuffer(table, dtype=numpy.uint8)
+                image[:, c] = lut[image[:, c]]
+        else:
+            for c, table in enumerate(tables):
+                samples[c::pix.n] = samples[c::pix.n].tobytes().translate(table)
+        with self.lock:
+            self.pixels += pix.width * pix.height
+            self.seconds += monotonic() - start
+
+    def stats(self):
+        if not self.pixels:
+            return 'filters: unused'
+        return 'filters: {:.1f} ms/MP over {:.1f} MP'.format(
+                self.seconds * 1000 * 1e6 / self.pixels, self.pixels / 1e6)
+
+# an image held by kitty
+Resident = namedtuple('Resident', ['key', 'size', 'last_used'])
+
+class Residency:
+    """
+    Keeps track of the images kitty holds for us: what was rendered
+    into each image id, how big it is, and when it was last used.
+    Cold images are deleted from kitty to stay within a budget.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.next_id = 1
+        self.images = OrderedDict()
+        self.size = 0
+        self.pinned = set()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def budget(self):
+        return int(config.TERMINAL_IMAGE_BUDGET * 1024 * 1024)
+
+    def image_id(self, filename, p):
+        # each page of each document gets its own image id
+        with self.lock:
+            image_id = self.ids.get((filename, p))
+            if image_id is None:
+                image_id = self.ids[(filename, p)] = self.next_id
+                self.next_id += 1
+            return image_id
+
+    def holds(self, image_id, key):
+        with self.lock:
+            resident = self.images.get(image_id)
+            if resident is None or resident.key != key:
+                return False
+            self.images[image_id] = resident._replace(last_used=monotonic())
+            self.images.move_to_end(image_id)
+            return True
+
+    def add(self, image_id, key, size):
+        with self.lock:
+            old = self.images.pop(image_id, None)
+            if old:
+                self.size -= old.size
+            self.images[image_id] = Resident(key, size, monotonic())
+            self.size += size
+            # delete the least recently used images, but never
+            # those on screen or the one just uploaded
+            for cold in list(self.images):
+                if self.size <= self.budget():
+                    break
+                if cold == image_id or cold in self.pinned:
+                    continue
+                self.delete(cold)
+                self.evictions += 1
+
+    def pin(self, image_ids):
+        # the images on screen are never evicted
+        with self.lock:
+            self.pinned = set(image_ids)
+            now = monotonic()
+            for image_id in self.pinned:
+                resident = self.images.get(image_id)
+                if resident:
+                    self.images[image_id] = resident._replace(last_used=now)
+                    self.images.move_to_end(image_id)
+
+    def delete(self, image_id):
+        resident = self.images.pop(image_id, None)
+        if resident:
+            self.size -= resident.size
+        write_gr_cmd({'a': 'd', 'd': 'I', 'i': image_id, 'q': 2})
+
+    def forget(self, image_id):
+        # kitty no longer holds the image
+        with self.lock:
+            resident = self.images.pop(image_id, None)
+            if resident:
+                self.size -= resident.size
+
+    def clear(self):
+        with self.lock:
+            for image_id in list(self.images):
+                self.delete(image_id)
+
+    def drop(self, filename):
+        # delete the images of a document's pages from kitty
+        with self.lock:
+            for (name, p), image_id in self.ids.items():
+                if name == filename and image_id in self.images:
+                    self.delete(image_id)
+
+    def stats(self):
+        return 'kitty: {} images, {:.1f}/{} MB, {} evictions'.format(
+                len(self.images), self.size / (1024 * 1024),
+                config.TERMINAL_IMAGE_BUDGET, self.evictions)
+
+class Text_Index:
+    """
+    An inverted index of the words on each page of a document, built
+    in a background thread and saved in the state store
+    """
+    def __init__(self, doc=None):
+        self.doc = doc
+        self.words = {}
+        self.ready = False
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def kind(self):
+        # an index is only good for the layout it was built from
+        if self.doc.is_reflowable:
+            return 'index:{:g}x{:g}:{:g}'.format(*self.doc.page_layout[2:])
+        return 'index'
+
+    def encode(self):
+        words = {word: postings.tolist() for word, postings in self.words.items()}
+        return json.dumps(words).encode()
+
+    def decode(self, data):
+        words = json.loads(data.decode())
+        return {word: array.array('I', postings) for word, postings in words.items()}
+
+    def run(self):
+        doc = self.doc
+        try:
+            key = file_identity.digest(doc.filename)
+            kind = self.kind()
+            data = state_store.load_blob(key, kind)
+            if data:
+                self.words = self.decode(data)
+                self.ready = True
+                return
+            words = {}
+            for p in range(doc.pages + 1):
+                with render_lock:
+                    # give up if the document was closed or laid out again
+                    if doc.is_closed or doc.text_index is not self:
+                        return
+                    page_words = doc.load_page(p).get_text('words')
+                self.add_page(words, p, page_words)
+            self.words = words
+            self.ready = True
+            state_store.save_blob(key, kind, self.encode())
+        except Exception:
+            logging.exception('unable to index ' + doc.filename)
+
+    def add_page(self, words, p, page_words):
+        # add the postings of the words on page p to words
+        for pos, w in enumerate(page_words):
+            postings = words.get(w[4].lower())
+            if postings is None:
+                postings = words[w[4].lower()] = array.array('I')
+            postings.extend((p, pos))
+
+    def positions(self, match):
+        # (page, position) of every word for which match is true
+        found = set()
+        for word, postings in self.words.items():
+            if match(word):
+                found.update(zip(postings[0::2], postings[1::2]))
+        return found
+
+    def matches(self, query):
+        # (page, position) of every match for query, ignoring case,
+        # or None if query is a pattern the index can't answer
+        if is_pattern(query):
+            return None
+        terms = query.lower().split()
+        if not terms:
+            return None
+        if len(terms) == 1:
+            return self.positions(lambda word: terms[0] in word)
+        # a phrase: the first term ends a word, the last starts one,
+        # and those between are whole words, all in a row
+        found = self.positions(lambda word: word.endswith(terms[0]))
+        for i, term in enumerate(terms[1:], 1):
+            if i == len(terms) - 1:
+                following = self.positions(lambda word: word.startswith(term))
+            else:
+                following = self.positions(lambda word: word == term)
+            found = set((p, pos) for p, pos in found if (p, pos + i) in following)
+        return found
+
+class Crop_Boxes:
+    """
+    The autocrop rectangle of every page of a document, found in a
+    background thread and saved in the state store as an array of
+    floats, four to a page
+    """
+    def __init__(self, doc, previous=None):
+        self.doc = doc
+        self.rects = array.array('f', [float('nan')] * (4 * (doc.pages + 1)))
+        # the rectangles of an earlier version of the document, by
+        # page fingerprint, for the pages that haven't changed
+        self.previous = previous or {}
+        # the union of the rectangles of the even and the odd pages
+        self.unions = [None, None]
+        self.ready = False
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def method(self):
+        # crop to the text, or to whatever isn't background, which
+        # needs numpy
+        method = config.AUTOCROP_METHOD
+        if method == 'auto':
+            method = 'pixels' if numpy is not None else 'text'
+        elif method == 'pixels' and numpy is None:
+            logging.warning('autocropping by pixels needs numpy')
+            method = 'text'
+        return method
+
+    def kind(self):
+        if self.method() == 'pixels':
+            return 'crops:pixels'
+        return 'crops'
+
+    def get(self, p):
+        rect = self.rects[4 * p:4 * p + 4]
+        if rect[0] != rect[0]:
+            # not measured yet
+            return None
+        return fitz.Rect(tuple(rect))
+
+    def put(self, p, rect):
+        self.rects[4 * p:4 * p + 4] = array.array('f', tuple(rect))
+        if not rect.is_empty:
+            union = self.unions[p % 2]
+            self.unions[p % 2] = rect if union is None else union | rect
+
+    def measure(self, page):
+        if self.method() == 'pixels':
+            return self.measure_pixels(page)
+        return self.measure_text(page)
+
+    def measure_pixels(self, page, scale=0.25):
+        # the area of page that differs from the background, found in
+        # a small grayscale rendering, or an empty rectangle if there
+        # is none
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY,
+                              alpha=False)
+        gray = numpy.frombuffer(pix.samples_mv, dtype=numpy.uint8)
+        gray = gray.reshape(pix.height, pix.stride)[:, :pix.width]
+        # most of a page is background, even on scans that aren't white
+        background = int(numpy.percentile(gray[::2, ::2], 90))
+        ink = gray < background - 40
+        # ignore specks of dust and noise
+        rows = numpy.flatnonzero(numpy.count_nonzero(ink, axis=1) > 1)
+        cols = numpy.flatnonzero(numpy.count_nonzero(ink, axis=0) > 1)
+        if not len(rows) or not len(cols):
+            return fitz.Rect()
+        # a pixel's margin around what we found, in page coordinates
+        rect = fitz.Rect(cols[0] - 1, rows[0] - 1, cols[-1] + 2, rows[-1] + 2)
+        rect = rect * fitz.Matrix(1 / scale, 1 / scale)
+        return rect + (page.rect.x0, page.rect.y0, page.rect.x0, page.rect.y0)
+
+    def measure_text(self, page):
+        # the area of page covered by text, or an empty rectangle if
+        # there is none
+        blocks = page.get_text_blocks()
+        if not blocks:
+            return fitz.Rect()
+        crop = fitz.Rect(blocks[0][:4])
+        for block in blocks:
+            crop = crop | fitz.Rect(block[:4])
+        return crop
+
+    def crop(self, p, page):
+        # the crop rectangle of page p, whose cropbox is its mediabox
+        if self.get(p) is None:
+            self.put(p, self.previous_crop(p) or self.measure(page))
+        return self.known_crop(p, page)
+
+    def previous_crop(self, p):
+        # page p's rectangle in the earlier version, if it is unchanged
+        if not self.previous:
+            return None
+        return self.previous.get(self.doc.page_fingerprint(p))
+
+    def by_fingerprint(self):
+        # the measured rectangles, by page fingerprint, for the next
+        # version of the document
+        rects = {}
+        for p, fingerprint in enumerate(self.doc.fingerprints):
+            rect = self.get(p)
+            if fingerprint and rect is not None:
+                rects[fingerprint] = rect
+        return rects
+
+    def known_crop(self, p, page):
+        # the crop rectangle of page p, or None if it hasn't been
+        # measured yet
+        rect = self.get(p)
+        if self.doc.autocrop_uniform and self.unions[p % 2] is not None:
+            # crop every even (or odd) page alike
+            rect = self.unions[p % 2]
+        elif rect is None:
+            return None
+        elif rect.is_empty:
+            # don't try to crop empty pages
+            return page.mediabox
+        return rect & page.mediabox
+
+    def run(self):
+        doc = self.doc
+        try:
+            key = doc.file_key
+            kind = self.kind()
+            data = state_store.load_blob(key, kind)
+            saved = data and len(data) == len(self.rects) * self.rects.itemsize
+            if saved:
+                rects = array.array('f')
+                rects.frombytes(data)
+                for p in range(len(rects) // 4):
+                    self.put(p, fitz.Rect(tuple(rects[4 * p:4 * p + 4])))
+                self.ready = True
+            for p in range(doc.pages + 1):
+                with render_lock:
+                    # give up if the document was closed or autocrop changed
+                    if doc.is_closed or doc.crop_boxes is not self:
+                        return
+                    if self.get(p) is None:
+                        rect = self.previous_crop(p)
+                        if rect is None:
+                            page = doc.load_page(p)
+                            page.set_cropbox(page.mediabox)
+                            rect = self.measure(page)
+                        self.put(p, rect)
+                    # for the next version to keep the rectangles of
+                    # the pages it leaves unchanged
+                    doc.page_fingerprint(p)
+            if not saved:
+                state_store.save_blob(key, kind, self.rects.tobytes())
+            self.previous = {}
+            self.ready = True
+            if doc.autocrop_uniform:
+                # the page on screen was cropped with part of the union
+                with render_lock:
+                    doc.mark_all_pages_stale()
+                wakeup.wake(Wakeup.REDRAW)
+        except Exception:
+            logging.exception('unable to find crop boxes for ' + doc.filename)
+
+def is_pattern(query):
+    # whether query uses regular expression syntax
+    return re.search(r'[\\.^$*+?{}\[\]|()]', query) is not None
+
+def search_regex(query):
+    # query compiled the way every search matches it: ignoring case
+    # unless it has an uppercase letter, and, unless it is a pattern,
+    # with its words matching across line breaks
+    flags = re.IGNORECASE if query == query.lower() else 0
+    if not is_pattern(query):
+        query = r'\s+'.join(map(re.escape, query.split()))
+    return re.compile(query, flags)
+
+def mediabox_matrix(page):
+    # the matrix taking the coordinates of page, which start at its
+    # crop box, to mediabox ones, which stay put when it is cropped
+    position = page.cropbox_position
+    return fitz.Matrix(1, 0, 0, 1, position.x, position.y)
+
+def count_matches(regex, text):
+    return sum(1 for _ in regex.finditer(text))
+
+def search_page(page, query):
+    # rectangles of the matches for query on page, in mediabox
+    # coordinates
+    regex = search_regex(query)
+    text = page.get_text('text')
+    needles = set(' '.join(m.group(0).split()) for m in regex.finditer(text))
+    if regex.flags & re.IGNORECASE:
+        # search_for ignores case too, so one spelling finds them all
+        needles = set(needle.lower() for needle in needles)
+    needles.discard('')
+    matrix = mediabox_matrix(page)
+    rects = []
+    for needle in needles:
+        found = page.search_for(needle)
+        if not regex.flags & re.IGNORECASE:
+            # search_for ignores case, so drop the hits that differ
+            # in it; a hit broken over lines is checked piece by piece
+            found = [rect for rect in found
+                     if needle in ' '.join(page.get_textbox(rect).split())
+                     or ' '.join(page.get_textbox(rect).split()) in needle]
+        rects.extend(tuple(rect * matrix) for rect in found)
+    return rects
+
+class Search_Results:
+    """
+    The hits for one search: the pages with matches, in order, the
+    number of matches on each, and the rectangles of the matches, kept
+    so that moving between hits and drawing them doesn't extract text
+    again
+    """
+    def __init__(self, query, pages=None, done=True):
+        self.query = query
+        self.pages = pages if pages is not None else []
+        self.counts = {}
+        self.rects = {}
+        self.done = done
+        # index in pages of the hit last jumped to
+        self.current = None
+
+    def add(self, p, count, rects=None):
+        i = bisect_left(self.pages, p)
+        if i == len(self.pages) or self.pages[i] != p:
+            self.pages.insert(i, p)
+            if self.current is not None and i <= self.current:
+                self.current += 1
+        self.counts[p] = count
+        if rects is not None:
+            self.rects[p] = rects
+
+    def matches(self, i):
+        # the numbers of the first and last matches on the page of
+        # hit i, and of all the matches found
+        before = sum(self.counts[p] for p in self.pages[:i])
+        return before + 1, before + self.counts[self.pages[i]], sum(self.counts.values())
+
+    def step(self, page, steps):
+        # index of the hit steps hits after page, or before it if
+        # steps is negative; from the hit last jumped to, this is O(1)
+        n = len(self.pages)
+        if self.current is not None and self.pages[self.current] == page:
+            return (self.current + steps) % n
+        if steps > 0:
+            return (bisect_right(self.pages, page) + steps - 1) % n
+        return (bisect_left(self.pages, page) + steps) % n
+
+    def first(self, page):
+        # index of the first hit on or after page
+        return bisect_left(self.pages, page) % len(self.pages)
+
+    def hit_rects(self, page, p):
+        # rectangles of the hits on page p, found on first use
+        rects = self.rects.get(p)
+        if rects is None:
+            rects = search_page(page, self.query) if p in self else []
+            self.rects[p] = rects
+        return rects
+
+    def __contains__(self, p):
+        i = bisect_left(self.pages, p)
+        return i < len(self.pages) and self.pages[i] == p
+
+class Library_Results:
+    """
+    The hits for a search across all buffers and, optionally, the
+    bibtex library: (citekey, logical page, snippet) for each page
+    with matches, ranked by the number of matches on the page
+    """
+    per_file = 20
+
+    def __init__(self, query, library=False):
+        self.query = query
+        self.library = library
+        self.hits = []
+        self.files = 0
+        self.searched = 0
+        self.done = False
+
+    def add(self, path, citekey, doc, hits):
+        self.searched += 1
+        name = citekey or os.path.basename(path)
+        for p, count, label, snippet in hits:
+            if doc and not doc.is_closed and p < doc.page_labels.count:
+                # open buffers may have their own page numbers
+                label = doc.page_to_logical(p)
+            insort(self.hits, (-count, name, p, label, snippet, path))
+
+# search workers run in their own processes, each with its own
+# handle on the documents it searches
+script_path = os.path.abspath(__file__)
+worker_generation = None
+worker_docs = {}
+
+def worker_init(generation):
+    global worker_generation
+    worker_generation = generation
+
+def start_workers(workers):
+    # a pool of worker processes, and the generation counter they
+    # check to skip work that has been cancelled
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn')
+    # python drops __main__.__file__ when the main thread finishes,
+    # but spawned workers need it to find their functions
+    main_module = sys.modules['__main__']
+    if __name__ == '__main__' and not getattr(main_module, '__file__', None):
+        main_module.__file__ = script_path
+    generation = ctx.Value('i', 0, lock=False)
+    return ctx.Pool(workers, worker_init, (generation,)), generation
+
+def worker_doc(filename, page_layout):
+    # the document, laid out as page_layout, a rect and font size, so
+    # that its pages are the ones the viewer shows
+    key = (filename, os.path.getmtime(filename), page_layout)
+    doc = worker_docs.get(key)
+    if doc is None:
+        doc = fitz.open(filename)
+        if page_layout:
+            doc.layout(fitz.Rect(page_layout[:4]), fontsize=page_layout[4])
+        worker_docs[key] = doc
+    return doc
+
+def search_block(args):
+    # the pages in a block that match pattern, with the number and
+    # rectangles of their matches, unless the search has been cancelled
+    filename, page_layout, pages, pattern, generation = args
+    hits = []
+    if worker_generation.value != generation:
+        return hits
+    doc = worker_doc(filename, page_layout)
+    regex = search_regex(pattern)
+    for p in pages:
+        if worker_generation.value != generation:
+            break
+        page = doc[p]
+        count = count_matches(regex, page.get_text('text'))
+        if count:
+            hits.append((p, count, search_page(page, pattern)))
+    return hits
+
+def search_file(args):
+    # the pages of a file with matches for query, as (page, matches,
+    # label, snippet), most matches first
+    path, kind, page_layout, query, generation = args
+    if worker_generation.value != generation:
+        return path, []
+    doc = worker_doc(path, page_layout)
+    regex = search_regex(query)
+    if is_pattern(query):
+        counts = {}
+        for p in range(doc.page_count):
+            if worker_generation.value != generation:
+                return path, []
+            n = len(regex.findall(doc[p].get_text('text')))
+            if n:
+                counts[p] = n
+    else:
+        # answer from the file's word index, building it if needed
+        if kind is None:
+            kind = 'index:default' if doc.is_reflowable else 'index'
+        key = file_identity.digest(path)
+        index = Text_Index()
+        data = state_store.load_blob(key, kind)
+        if data:
+            index.words = index.decode(data)
+        else:
+            for p in range(doc.page_count):
+                if worker_generation.value != generation:
+                    return path, []
+                index.add_page(index.words, p, doc[p].get_text('words'))
+            state_store.save_blob(key, kind, index.encode())
+        counts = {}
+        for p, pos in index.matches(query) or ():
+            counts[p] = counts.get(p, 0) + 1
+    hits = []
+    for p in sorted(counts, key=lambda p: (-counts[p], p)):
+        text = ' '.join(doc[p].get_text('text').split())
+        m = regex.search(text)
+        if not m:
+            # the index ignores case
+            continue
+        snippet = text[max(0, m.start() - 30):m.end() + 50]
+        hits.append((p, counts[p], doc[p].get_label() or str(p + 1), snippet))
+        if len(hits) == Library_Results.per_file:
+            break
+    return path, hits
+
+def render_pixels(args):
+    # the samples of a page rendered at full resolution, as (width,
+    # height, alpha, samples, seconds the render took), or None if
+    # the render was cancelled
+    filename, page_layout, p, crop, rotation, factor, alpha, generation = args
+    if worker_generation.value != generation:
+        return None
+    doc = worker_doc(filename, page_layout)
+    page = doc[p]
+    if crop:
+        page.set_cropbox(page.mediabox)
+        page.set_cropbox(fitz.Rect(crop))
+    mat = fitz.Matrix(factor, factor).prerotate(rotation)
+    start = monotonic()
+    pix = page.get_pixmap(matrix=mat, alpha=alpha)
+    return pix.width, pix.height, pix.alpha, pix.samples, monotonic() - start
+
+def render_thumbnail(args):
+    # write a png of a page that fits in a square of size pixels to
+    # path, and return the page number, or None if it was cancelled
+    filename, page_layout, p, size, path, generation = args
+    if worker_generation.value != generation:
+        return None
+    if not os.path.exists(path):
+        doc = worker_doc(filename, page_layout)
+        page = doc[p]
+        if doc.is_pdf:
+            # as the viewer shows it uncropped
+            page.set_cropbox(page.mediabox)
+        zoom = size / max(page.rect.width, page.rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        # other instances may be writing the same thumbnail
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        pix.save(temp, 'png')
+        os.replace(temp, path)
+    return p
+
+class Search_Pool:
+    """
+    Searches for regular expressions in a pool of worker processes,
+    streaming hits back to the document as they are found
+    """
+    block = 8
+
+    def __init__(self):
+        self.pool = None
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def start_pool(self):
+        if self.pool is None:
+            workers = config.SEARCH_WORKERS or min(4, os.cpu_count() or 1)
+            self.pool, self.generation = start_workers(workers)
+        return self.pool
+
+    def cancel(self):
+        # queued blocks of older searches return at once
+        if self.generation is not None:
+            self.generation.value += 1
+
+    def search(self, doc, results, start):
+        pool = self.start_pool()
+        self.cancel()
+        generation = self.generation.value
+        pattern = results.query
+        # search from start to the end, then from the beginning
+        n = doc.pages + 1
+        order = list(range(start, n)) + list(range(0, start))
+        blocks = [order[i:i + self.block] for i in range(0, n, self.block)]
+        args = [(doc.filename, doc.page_layout, block, pattern, generation) for block in blocks]
+        results.done = False
+        # imap returns results in order, so the first hit found is
+        # the first one after start
+        blocks_done = pool.imap(search_block, args)
+
+        def collect():
+            try:
+                for hits in blocks_done:
+                    if self.generation.value != generation:
+                        return
+                    for p, count, rects in hits:
+                        results.add(p, count, rects)
+                        # it may have been drawn before its hits arrived
+                        doc.page_states[p].stale = True
+                    if hits:
+                        wakeup.wake(Wakeup.SEARCH)
+            except Exception:
+                logging.exception('search failed')
+            if self.generation.value == generation:
+                results.done = True
+                wakeup.wake(Wakeup.SEARCH)
+
+        thread = threading.Thread(target=collect)
+        thread.daemon = True
+        thread.start()
+
+    def search_files(self, targets, results):
+        # search each of targets, (path, citekey, doc), in full, and
+        # the files of the bibtex library if results.library is set
+        pool = self.start_pool()
+        self.cancel()
+        generation = self.generation.value
+
+        def collect():
+            try:
+                found = list(targets)
+                if results.library:
+                    open_paths = set(os.path.abspath(path) for path, _, _ in found)
+                    for citekey, path in library_files():
+                        if os.path.abspath(path) not in open_paths:
+                            found.append((path, citekey, None))
+                docs = {path: (citekey, doc) for path, citekey, doc in found}
+                results.files = len(docs)
+                args = []
+                for path, citekey, doc in found:
+                    kind = Text_Index(doc).kind() if doc else None
+                    page_layout = doc.page_layout if doc else None
+                    args.append((path, kind, page_layout, results.query, generation))
+                for path, hits in pool.imap_unordered(search_file, args):
+                    if self.generation.value != generation:
+                        return
+                    citekey, doc = docs[path]
+                    results.add(path, citekey, doc, hits)
+                    wakeup.wake(Wakeup.SEARCH)
+            except Exception:
+                logging.exception('search failed')
+            if self.generation.value == generation:
+                results.done = True
+                wakeup.wake(Wakeup.SEARCH)
+
+        thread = threading.Thread(target=collect)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+
+class Render_Pool:
+    """
+    Renders heavy pages at full resolution in worker processes, while
+    the viewer shows a quick preview and keeps reading keys
+    """
+    def __init__(self):
+        self.pool = None
+        self.generation = None
+        self.job = None
+
+    def start_pool(self):
+        if self.pool is None:
+            workers = config.RENDER_WORKERS or min(2, os.cpu_count() or 1)
+            self.pool, self.generation = start_workers(workers)
+        return self.pool
+
+    def pending(self, doc, p):
+        return self.job == (doc, p)
+
+    def cancel(self):
+        # drop queued thumbnails, and the render of the page being
+        # previewed, which will be asked for again if the page is
+        # shown again
+        if self.generation is None:
+            return
+        self.generation.value += 1
+        if self.job is None:
+            return
+        doc, p = self.job
+        self.job = None
+        if p < len(doc.page_states):
+            doc.page_states[p].stale = True
+
+    def follow(self, doc, p):
+        # cancel the render if the viewer has moved on from its page
+        if self.job is not None and self.job != (doc, p):
+            self.cancel()
+
+    def render(self, doc, p, page, key, factor, hits):
+        pool = self.start_pool()
+        self.cancel()
+        self.job = (doc, p)
+        generation = self.generation.value
+        crop = tuple(page.cropbox) if doc.is_pdf else None
+        args = (doc.filename, doc.page_layout, p, crop, doc.rotation, factor,
+                doc.alpha, generation)
+        invert, tint_color = doc.invert, doc.tint_color if doc.tint else None
+
+        def done(result):
+            if result is None or self.generation.value != generation:
+                return
+            width, height, alpha, samples, seconds = result
+            if p < len(doc.page_states):
+                doc.page_states[p].note_render(seconds, width * height)
+            pix = fitz.Pixmap(fitz.csRGB, width, height, samples, alpha)
+            color_filter.apply(pix, invert, tint_color)
+            mat = fitz.Matrix(factor, factor).prerotate(doc.rotation)
+            for rect in hits:
+                pix.invert_irect((fitz.Rect(rect) * mat).irect & pix.irect)
+            rendered = Rendered(pix.width, pix.height, pix.alpha, pix.samples)
+            render_cache.put(key, rendered)
+            with render_lock:
+                if self.generation.value != generation or doc.is_closed:
+                    return
+                self.job = None
+                image_id = doc.image_id(p)
+                doc.upload_page(p, rendered)
+                residency.add(image_id, key, len(rendered.samples))
+                # place the full render over the preview
+                doc.page_states[p].stale = True
+            wakeup.wake(Wakeup.REDRAW)
+
+        def failed(error):
+            logging.error('unable to render page {} of {}: {}'.format(p, doc.filename, error))
+            if self.generation.value == generation:
+                # render it the slow way
+                self.job = None
+                doc.page_states[p].stale = True
+                doc.page_states[p].progressive = False
+                wakeup.wake(Wakeup.REDRAW)
+
+        pool.apply_async(render_pixels, (args,), callback=done, error_callback=failed)
+
+    def render_thumbnails(self, doc, pages, ready):
+        # write the thumbnails of pages that aren't cached yet, in
+        # roughly that order, adding each page to ready when its
+        # thumbnail is
+        pool = self.start_pool()
+        self.cancel()
+        generation = self.generation.value
+        args = [(doc.filename, doc.page_layout, p, config.THUMBNAIL_SIZE,
+                 doc.thumbnail_path(p), generation) for p in pages]
+
+        def collect():
+            try:
+                for p in pool.imap_unordered(render_thumbnail, args):
+                    if self.generation.value != generation:
+                        return
+                    ready.add(p)
+                    wakeup.wake(Wakeup.REDRAW)
+            except Exception:
+                logging.exception('unable to render thumbnails of ' + doc.filename)
+
+        thread = threading.Thread(target=collect)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+
+class Outline:
+    """
+    A document's table of contents, loaded once, as arrays of levels
+    and pages, with the running maximum of the start pages so that the
+    chapter containing a page can be found by bisection
+    """
+    def __init__(self, toc):
+        self.levels = array.array('H', (entry[0] for entry in toc))
+        self.titles = [entry[1] for entry in toc]
+        self.pages = array.array('i', (entry[2] for entry in toc))
+        # outlines needn't be in page order
+        self.starts = array.array('i', self.pages)
+        for i in range(1, len(self.starts)):
+            self.starts[i] = max(self.starts[i], self.starts[i - 1])
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, i):
+        return self.levels[i], self.titles[i], self.pages[i]
+
+    def chapter(self, p):
+        # index of the last entry starting on or before page p, or -1
+        return bisect_right(self.starts, p + 1) - 1
+
+class Page_Stack:
+    """
+    A document's pages stacked one above the other, as arrays of the
+    heights of their images and the offsets of their tops, so that the
+    page at a scroll position can be found by bisection
+    """
+    # pixels between pages
+    gap = 8
+
+    def __init__(self, heights):
+        self.heights = array.array('I', heights)
+        self.tops = array.array('Q', bytes(8 * len(self.heights)))
+        self.total = 0
+        self.stale = False
+        self.update(0)
+
+    def update(self, start):
+        # recompute the offsets of the pages from start on
+        top = 0
+        if start:
+            top = self.tops[start - 1] + self.heights[start - 1] + self.gap
+        for p in range(start, len(self.heights)):
+            self.tops[p] = top
+            top += self.heights[p] + self.gap
+        self.total = top - self.gap
+
+    def resize(self, p, height):
+        # change the height of page p, and return how much it grew
+        grown = height - self.heights[p]
+        if grown:
+            self.heights[p] = height
+            self.update(p + 1)
+        return grown
+
+    def page_at(self, y):
+        return max(0, bisect_right(self.tops, y) - 1)
+
+    def pages_between(self, top, bottom):
+        # the pages that show between two scroll positions
+        return range(self.page_at(top), self.page_at(bottom - 1) + 1)
+
+class Page_Labels:
+    """
+    Logical page numbers, stored as runs of pages sharing a label
+    style, like the page labels of a PDF. A per-page array of run
+    numbers, and a dict built on first use, make lookups in both
+    directions constant time.
+    """
+    def __init__(self, count, ranges):
+        # ranges are (startpage, style, prefix, firstpagenum), with
+        # the styles of fitz's get_page_labels
+        self.ranges = sorted(ranges) or [(0, 'D', '', 1)]
+        if self.ranges[0][0] > 0:
+            # pages before the first label are numbered from 1
+            self.ranges.insert(0, (0, 'D', '', 1))
+        self.count = count
+        self.run = array.array('I', bytes(4 * count))
+        for i in range(1, len(self.ranges)):
+            start = self.ranges[i][0]
+            end = self.ranges[i + 1][0] if i + 1 < len(self.ranges) else count
+            for p in range(start, min(end, count)):
+                self.run[p] = i
+        self.pages = None
+
+    @classmethod
+    def for_document(cls, doc):
+        # the labels of a PDF, read by MuPDF and cached in the state
+        # store, or the offset numbering of other documents
+        count = doc.pages + 1
+        if not doc.is_pdf:
+            return cls(count, [(0, 'D', '', doc.first_page_offset)])
+        # labels edited but not yet saved are only in the document
+        key = None if doc.labels_modified else file_identity.digest(doc.filename)
+        data = state_store.load_blob(key, 'labels') if key else None
+        if data is not None:
+            ranges = [tuple(r) for r in json.loads(data.decode())]
+        else:
+            try:
+                with render_lock:
+                    labels = doc.get_page_labels()
+            except Exception:
+                labels = []
+            ranges = [(l['startpage'], l.get('style', ''), l.get('prefix', ''),
+                       l.get('firstpagenum', 1)) for l in labels]
+            if key:
+                state_store.save_blob(key, 'labels', json.dumps(ranges).encode())
+        if not ranges:
+            ranges = [(0, 'D', '', doc.first_page_offset)]
+        return cls(count, ranges)
+
+    def label(self, p):
+        startpage, style, prefix, first = self.ranges[self.run[p]]
+        n = p - startpage + first
+        if style == 'D':
+            return prefix + str(n)
+        elif style == 'r':
+            return prefix + roman.toRoman(n).lower()
+        elif style == 'R':
+            return prefix + roman.toRoman(n).upper()
+        elif style == 'a':
+            return prefix + self.alphabetic(n).lower()
+        elif style == 'A':
+            return prefix + self.alphabetic(n)
+        return prefix
+
+    def alphabetic(self, n):
+        # A to Z, then AA to ZZ, and so on
+        a, b = divmod(n - 1, 26)
+        return string.ascii_uppercase[b] * (a + 1)
+
+    def page(self, label):
+        # the first page with label, or None
+        if self.pages is None:
+            pages = {}
+            for p in range(self.count - 1, -1, -1):
+                pages[self.label(p)] = p
+            self.pages = pages
+        return self.pages.get(str(label))
 
 class Document(fitz.Document):
     """
     An extension of the fitz.Document class, with extra attributes
     """
+    paper_sizes = ['a7','c7','b7','a6','c6','b6','a5','c5','b5','a4']
+    # scale of the quick first pass over a page that is slow to render
+    preview_scale = 0.25
+    # first image id of the thumbnail grid, well clear of the pages'
+    thumbnail_ids = 1 << 24
+
     def __init__(self, filename=None, filetype=None, rect=None, width=0, height=0, fontsize=12):
         fitz.Document.__init__(self, filename, None, filetype, rect, width, height, fontsize)
         self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        # the key of this version of the file in the state store
+        self.file_key = file_identity.digest(filename)
         self.citekey = None
         self.papersize = 3
         self.layout(rect=fitz.paper_rect('A6'),fontsize=fontsize)
         self.page = 0
         self.logicalpage = 1
         self.prevpage = 0
+        self.direction = 1
         self.pages = self.page_count - 1
         self.first_page_offset = 1
-        self.logical_pages = list(range(0 + self.first_page_offset, self.pages + self.first_page_offset))
+        self.page_labels = Page_Labels(self.pages + 1, [])
+        self.labels_modified = False
+        self.label_timer = None
         self.chapter = 0
+        self.chapters = None
         self.rotation = 0
+        self.fit = 'page'
+        self.scroll = 0
+        self.page_stack = None
+        self.stacked = set()
         self.fontsize = fontsize
         self.width = width
         self.height = height
         self.autocrop = False
+        self.autocrop_uniform = False
+        self.crop_boxes = None
         self.manualcrop = False
         self.manualcroprect = [None,None]
         self.alpha = False
@@ -288,24 +1706,37 @@ class Document(fitz.Document):
         self.nvim = None
         self.nvim_listen_address = '/tmp/termpdf_nvim_bridge'
         self.page_states = [ Page_State(i) for i in range(0,self.pages + 1) ]
-
-    def write_state(self):
-        cachefile = get_cachefile(self.filename)
-        state = {'citekey': self.citekey,
+        self.fingerprints = [None] * (self.pages + 1)
+        self.object_digests = {}
+        self.page_layout = self.layout_of(fitz.paper_rect('A6'))
+        self.page_counts = {}
+        self.pending_papersize = None
+        self.layout_timer = None
+        self.layout_due = False
+        self.text_index = None
+        self.search = None
+        self.search_cache = OrderedDict()
+        self.search_waiting = False
+        self.search_start = 0
+
+    def state(self):
+        return {'citekey': self.citekey,
                  'papersize': self.papersize,
                  'page': self.page,
                  'logicalpage': self.logicalpage,
                  'first_page_offset': self.first_page_offset,
                  'chapter': self.chapter,
                  'rotation': self.rotation,
+                 'fit': self.fit,
+                 'scroll': self.scroll,
                  'autocrop': self.autocrop,
+                 'autocrop_uniform': self.autocrop_uniform,
                  'manualcrop': self.manualcrop,
                  'manualcroprect': self.manualcroprect,
                  'alpha': self.alpha,
                  'invert': self.invert,
-                 'tint': self.tint}
-        with open(cachefile, 'w') as f:
-            json.dump(state, f)
+                 'tint': self.tint,
+                 'page_counts': self.page_counts}
 
     def goto_page(self, p):
         # store prevpage 
@@ -319,6 +1750,14 @@ class Document(fitz.Document):
             self.page = 0
         else:
             self.page = p
+        # start at the top of the page when scrolling
+        if self.page != self.prevpage:
+            self.scroll = None if self.fit == 'continuous' else 0
+        # remember which way we are paging, for the prefetcher
+        if self.page > self.prevpage:
+            self.direction = 1
+        elif self.page < self.prevpage:
+            self.direction = -1
         self.logicalpage = self.page_to_logical(self.page)
     
     def goto_logical_page(self, p):
@@ -331,11 +1770,18 @@ class Document(fitz.Document):
     def prev_page(self, count=1):
         self.goto_page(self.page - count)
 
+    def get_chapters(self):
+        # the table of contents, loaded on first use
+        if self.chapters is None:
+            with render_lock:
+                self.chapters = Outline(self.get_toc())
+        return self.chapters
+
     def goto_chap(self, n):
-        toc = self.get_toc()
-        if n > len(toc):
-            n = len(toc)
-        elif n < 0:
+        toc = self.get_chapters()
+        if n > len(toc) - 1:
+            n = len(toc) - 1
+        if n < 0:
             n = 0
         self.chapter = n
         try:
@@ -344,13 +1790,7 @@ class Document(fitz.Document):
             self.goto_page(0)
 
     def current_chap(self):
-        toc = self.get_toc()
-        p = self.page
-        for i,ch in enumerate(toc):
-           cp = ch[2] - 1
-           if cp > p:
-               return i - 1
-        return len(toc)
+        return self.get_chapters().chapter(self.page)
 
     def next_chap(self, count=1):
         self.goto_chap(self.chapter + count)
@@ -358,110 +1798,83 @@ class Document(fitz.Document):
     def prev_chap(self, count=1):
         self.goto_chap(self.chapter - count)
 
-    def parse_pagelabels(self):
-        if self.is_pdf:
-            from pdfrw import PdfReader
-            from pagelabels import PageLabels, PageLabelScheme
-            try:
-                reader = PdfReader(self.filename)
-                labels = PageLabels.from_pdf(reader)
-                labels = sorted(labels, key=attrgetter('startpage'))
-            except:
-                labels = []
-        else:
-            labels = []
-        return labels
-
     def set_pagelabel(self,count,style="arabic"):
+        # number pages from the current one on, starting with count;
+        # the labels are saved after a pause, so that a run of edits
+        # is written to the file once
         if self.is_pdf:
-            from pdfrw import PdfReader, PdfWriter
-            from pagelabels import PageLabels, PageLabelScheme
-            reader = PdfReader(self.filename)
-            labels = PageLabels.from_pdf(reader)
-            newlabels = PageLabels()
-            for label in labels:
-                if label.startpage != self.page:
-                    newlabels.append(label)
-
-            newlabel = PageLabelScheme(startpage=self.page, 
-                                       style=style,
-                                       prefix="",
-                                       firstpagenum=count) 
-            newlabels.append(newlabel) 
-            newlabels.write(reader)
-
-            writer = PdfWriter()
-            writer.trailer = reader
-            logging.debug("writing new pagelabels...")
-            writer.write(self.filename)
-
-    # unused; using pdfrw instead
-    def parse_pagelabels_pure(self):
-        cat = self._getPDFroot()
-
-        cat_str = self._getXrefString(cat)
-        lines = cat_str.split('\n')
-        labels = []
-        for line in lines:
-            match = re.search('/PageLabels',line)
-            if re.match(r'.*/PageLabels.*', line):
-                labels += [line]
-        logging.debug(labels)
-        raise SystemExit
+            styles = {'arabic': 'D',
+                      'roman lowercase': 'r',
+                      'roman uppercase': 'R',
+                      'alphabetic lowercase': 'a',
+                      'alphabetic uppercase': 'A'}
+            ranges = [r for r in self.page_labels.ranges if r[0] != self.page]
+            ranges.append((self.page, styles[style], '', count))
+            labels = [{'startpage': startpage, 'style': style, 'prefix': prefix,
+                       'firstpagenum': first}
+                      for startpage, style, prefix, first in sorted(ranges)]
+            with render_lock:
+                self.set_page_labels(labels)
+            self.labels_modified = True
+            if self.label_timer:
+                self.label_timer.cancel()
+            self.label_timer = threading.Timer(2, self.write_pagelabels)
+            self.label_timer.daemon = True
+            self.label_timer.start()
+
+    def write_pagelabels(self):
+        # append the edited labels to the file as an incremental
+        # update, which the file watcher is told to ignore; the
+        # labels go through a handle of their own, since this one
+        # holds the crop boxes set for display, which must not be
+        # written to the file
+        with render_lock:
+            if self.is_closed or not self.labels_modified:
+                return
+            if self.label_timer:
+                self.label_timer.cancel()
+                self.label_timer = None
+            old_key = file_identity.digest(self.filename)
+            try:
+                out = fitz.open(self.filename)
+                try:
+                    out.set_page_labels(self.get_page_labels())
+                    if out.can_save_incrementally():
+                        out.saveIncr()
+                        watcher.ignore(self.filename)
+                    else:
+                        # write a new file beside the old one and move it
+                        # into place; the file watcher then reloads it
+                        path = os.path.abspath(self.filename)
+                        with NamedTemporaryFile(dir=os.path.dirname(path), suffix='.pdf',
+                                                delete=False) as f:
+                            tmp = f.name
+                        out.save(tmp, garbage=1)
+                        shutil.copymode(path, tmp)
+                        os.replace(tmp, path)
+                finally:
+                    out.close()
+            except Exception:
+                logging.exception('unable to save page labels to ' + self.filename)
+                return
+            self.labels_modified = False
+            self.mtime = os.path.getmtime(self.filename)
+            self.file_key = file_identity.digest(self.filename)
+            state_store.rekey(old_key, self.file_key)
 
     def pages_to_logical_pages(self):
-        labels = self.parse_pagelabels()
-        self.logical_pages = list(range(0,self.pages + 1))
-
-        def divmod_alphabetic(n):
-            a, b = divmod(n, 26)
-            if b == 0:
-                return a - 1, b + 26
-            return a, b
-
-        def to_alphabetic(n):
-            chars = []
-            while n > 0:
-                n, d = divmod_alphabetic(n)
-                chars.append(string.ascii_uppercase[d - 1])
-            return ''.join(reversed(chars))
-
-        if labels == []:
-            for p in range(0,self.pages + 1):
-                self.logical_pages[p] = str(p + self.first_page_offset)
-        else:
-            for p in range(0,self.pages + 1):
-                for label in labels:
-                    if p >= label.startpage:
-                        lp = (p - label.startpage) + label.firstpagenum
-                        style = label.style
-                        prefix = label.prefix
-                if style == 'roman uppercase':
-                    lp = prefix + roman.toRoman(lp)
-                    lp = lp.upper()
-                elif style == 'roman lowercase':
-                    lp = prefix + roman.toRoman(lp)
-                    lp = lp.lower()
-                elif style == 'alphabetic uppercase':
-                    lp = prefix + to_alphabetic(lp) 
-                elif style == 'alphabetic lowercase':
-                    lp = prefix + to_alphabetic(lp)
-                    lp = lp.lower()
-                else:
-                    lp = prefix + str(lp)
-                self.logical_pages[p] = lp 
+        self.page_labels = Page_Labels.for_document(self)
 
     def page_to_logical(self, p=None):
-        if not p:
+        if p is None:
             p = self.page
-        return self.logical_pages[p]
+        return self.page_labels.label(p)
 
     def logical_to_page(self, lp=None):
-        if not lp:
+        if lp is None:
             lp = self.logicalpage
-        try:
-            p = self.logical_pages.index(str(lp))
-        except:
+        p = self.page_labels.page(lp)
+        if p is None:
             # no such logical page in document
             p = 0
         return p
@@ -473,74 +1886,108 @@ class Document(fitz.Document):
         else:
             return '({}, {}, {})'.format(self.metadata['author'],self.metadata['title'], p)
 
-    def find_target(self, target, target_text):
-        # since our pct calculation is at best an estimate
-        # of the correct target page, we search for the first 
-        # few words of the original page on the surrounding pages
-        # until we find a match
-        for i in [0,1,-1,2,-2,3,-3,4,-4,5,-5,6,-6]:
-            f = target + i
-            match_text = self[f].get_text().split()
-            match_text = ' '.join(match_text)
-            if target_text in match_text:
-                return f
-        return target
-
-
     def set_layout(self,papersize, adjustpage=True):
-        # save a snippet of text from current page
-        target_text = self[self.page].get_text().split()
-        if len(target_text) > 6:
-            target_text = ' '.join(target_text[:6])
-        elif len(target_text) > 0:
-            target_text = ' '.join(target_text)
-        else:
-            target_text = ''
-
-        pct = (self.page + 1) / (self.pages + 1)
-        sizes = ['a7','c7','b7','a6','c6','b6','a5','c5','b5','a4']
-        if papersize > len(sizes) - 1:
-            papersize = len(sizes) - 1
-        elif papersize < 0:
-            papersize = 0
-        p = sizes[papersize]
-        self.layout(fitz.paper_rect(p))
-        self.pages = self.page_count - 1
-        if adjustpage:
-            target = int((self.pages + 1) * pct) - 1
-            target = self.find_target(target, target_text)
-            self.goto_page(target)
-        self.papersize = papersize 
+        papersize = self.clamp_papersize(papersize)
+        rect = fitz.paper_rect(self.paper_sizes[papersize])
+        # only reflowable documents have layouts, and laying out a
+        # book again is slow, so do it only if the size has changed
+        if self.is_reflowable and self.layout_of(rect) != self.page_layout:
+            if adjustpage:
+                # mark our place in the text, to find it in the new layout
+                bookmark = self.make_bookmark(self.location_from_page_number(self.page))
+            self.layout(rect, fontsize=self.fontsize)
+            self.page_layout = self.layout_of(rect)
+            self.pages = self.page_count - 1
+            self.page_counts[str(papersize)] = self.pages + 1
+            self.fingerprints = [None] * (self.pages + 1)
+            # chapters move with the layout
+            self.chapters = None
+            if self.text_index:
+                self.text_index = None
+                self.start_indexing()
+            if adjustpage:
+                self.goto_page(self.page_number_from_location(self.find_bookmark(bookmark)))
         self.pages_to_logical_pages()
+        self.papersize = papersize 
+
+    def layout_of(self, rect):
+        # the page size and font size a layout to rect uses, for the
+        # workers to lay the file out the same way, or None if the
+        # document has fixed pages
+        if not self.is_reflowable:
+            return None
+        return tuple(rect) + (self.fontsize,)
+
+    def clamp_papersize(self, papersize):
+        return max(0, min(papersize, len(self.paper_sizes) - 1))
+
+    def request_layout(self, papersize):
+        # change the layout once the keys to change it stop coming,
+        # so that a run of font size changes is laid out once, and
+        # the old layout stays on screen until then
+        if self.pending_papersize is not None:
+            papersize += self.pending_papersize - self.papersize
+        papersize = self.clamp_papersize(papersize)
+        self.pending_papersize = papersize
+        if self.layout_timer:
+            self.layout_timer.cancel()
+        self.layout_due = False
+        self.layout_timer = threading.Timer(0.3, self.layout_ready)
+        self.layout_timer.daemon = True
+        self.layout_timer.start()
+        count = self.page_counts.get(str(papersize))
+        if count:
+            return 'font size {} ({} pages)'.format(papersize, count)
+        return 'font size {}'.format(papersize)
+
+    def layout_ready(self):
+        self.layout_due = True
+        wakeup.wake(Wakeup.RELAYOUT)
+
+    def apply_layout(self):
+        # carry out a requested change of layout, once it is due
+        papersize = self.pending_papersize
+        if papersize is None or not self.layout_due:
+            return False
+        self.pending_papersize = None
+        with render_lock:
+            self.set_layout(papersize)
+        self.mark_all_pages_stale()
+        return True
 
     def mark_all_pages_stale(self):
         self.page_states = [ Page_State(i) for i in range(0,self.pages + 1) ]
+        if self.page_stack:
+            # pages may have changed size
+            self.page_stack.stale = True
 
     def clear_page(self, p):
-        cmd = {'a': 'd', 'd': 'a', 'i': p + 1}
+        cmd = {'a': 'd', 'd': 'a', 'i': self.image_id(p)}
         write_gr_cmd(cmd)
 
     def cells_to_pixels(self, *coords):
         factor = self.page_states[self.page].factor
         l,t,_,_ = self.page_states[self.page].place
+        scroll = self.page_scroll()
         pix_coords = []
         for coord in coords:
             col = coord[0]
             row = coord[1]
             x = (col - l) * scr.cell_width / factor
-            y = (row - t) * scr.cell_height  / factor
+            y = ((row - t) * scr.cell_height + scroll) / factor
             pix_coords.append((x,y))
         return pix_coords
 
     def pixels_to_cells(self, *coords):
         factor = self.page_states[self.page].factor
         l,t,_,_ = self.page_states[self.page].place
+        scroll = self.page_scroll()
         cell_coords = []
         for coord in coords:
             x = coord[0]
             y = coord[1]
             col = (x * factor + l * scr.cell_width) / scr.cell_width
-            row = (y * factor + t * scr.cell_height) / scr.cell_height
+            row = (y * factor - scroll + t * scr.cell_height) / scr.cell_height
             col = int(col)
             row = int(row)
             cell_coords.append((col,row))
@@ -551,6 +1998,7 @@ class Document(fitz.Document):
         from operator import itemgetter
         from itertools import groupby
         page = self.load_page(self.page)
+        self.crop_page(page)
         words = page.get_text_words()
         mywords = [w for w in words if fitz.Rect(w[:4]) in rect]
         mywords.sort(key=itemgetter(3, 0))  # sort by y1, x0 of the word rect
@@ -565,6 +2013,7 @@ class Document(fitz.Document):
         from operator import itemgetter
         from itertools import groupby
         page = self.load_page(self.page)
+        self.crop_page(page)
         words = page.get_text_words()
         mywords = [w for w in words if fitz.Rect(w[:4]).intersects(rect)]
         mywords.sort(key=itemgetter(3, 0))  # sort by y1, x0 of the word rect
@@ -574,126 +2023,737 @@ class Document(fitz.Document):
             text = text + [" ".join(w[4] for w in gwords)]
         return text
 
-    def search_text(self,string):
-        for p in range(self.page,self.pages):
-            page_text = self.get_page_text(p, 'text')
-            if re.search(string,page_text):
-                self.goto_page(p)
-                return "match on page"
-        return "no matches"
-
-    def auto_crop(self,page):
-        blocks = page.get_text_blocks()
+    def start_indexing(self):
+        if not self.text_index:
+            self.text_index = Text_Index(self)
+        self.text_index.start()
 
-        if len(blocks) > 0:
-            crop = fitz.Rect(blocks[0][:4])
+    def search_text(self,string):
+        try:
+            re.compile(string)
+        except re.error:
+            return 'invalid pattern'
+        self.end_search()
+        results = self.search_cache.pop(string, None)
+        if results is None:
+            results = Search_Results(string)
+            index = self.text_index
+            found = None
+            if index and index.ready:
+                found = index.matches(string)
+            if found is not None:
+                counts = {}
+                for p, pos in found:
+                    counts[p] = counts.get(p, 0) + 1
+                if string != string.lower():
+                    # the index ignores case, so count its hits again
+                    regex = search_regex(string)
+                    counts = dict((p, count_matches(regex, self.get_page_text(p, 'text')))
+                                  for p in counts)
+                for p in sorted(counts):
+                    if counts[p]:
+                        results.add(p, counts[p])
+            else:
+                # search in the background, and jump to the first hit
+                # when it arrives
+                try:
+                    search_pool.search(self, results, self.page)
+                except Exception:
+                    logging.exception('unable to start search workers')
+                    self.scan_pages(results)
+        self.search_cache[string] = results
+        while len(self.search_cache) > 8:
+            self.search_cache.popitem(last=False)
+        self.search = results
+        self.mark_all_pages_stale()
+        if not results.done:
+            self.search_waiting = True
+            self.search_start = self.page
+            return 'searching...'
+        return self.goto_hit(0)
+
+    def scan_pages(self, results):
+        # search every page, for when the search workers can't
+        regex = search_regex(results.query)
+        for p in range(self.pages + 1):
+            count = count_matches(regex, self.get_page_text(p, 'text'))
+            if count:
+                results.add(p, count)
+
+    def update_search(self):
+        # follow hits streaming in from search_pool
+        results = self.search
+        if not self.search_waiting or results is None:
+            return None
+        if results.pages:
+            self.search_waiting = False
+            return self.goto_hit(0, self.search_start)
+        if results.done:
+            self.search_waiting = False
+            return "no matches"
+        return None
+
+    def end_search(self):
+        results = self.search
+        if results is None:
+            return
+        if not results.done:
+            # incomplete results aren't worth keeping
+            search_pool.cancel()
+            if self.search_cache.get(results.query) is results:
+                del self.search_cache[results.query]
+        self.search = None
+        self.search_waiting = False
+        # remove the highlights
+        self.mark_all_pages_stale()
+
+    def goto_hit(self, steps=1, start=None):
+        # go to the hit steps hits after (or before) the current page,
+        # wrapping around the end of the document; with steps 0, go to
+        # the first hit on or after start
+        results = self.search
+        if not results.pages:
+            return "no matches" if results.done else "searching..."
+        if steps == 0:
+            i = results.first(self.page if start is None else start)
         else:
-            # don't try to crop empty pages
-            crop = fitz.Rect(0,0,0,0)
-        for block in blocks:
-            b = fitz.Rect(block[:4])
-            crop = crop | b
-
-        return crop
-
-    def display_page(self, bar, p, display=True):
-
-        page = self.load_page(p)
-        page_state = self.page_states[p]
-
+            i = results.step(self.page, steps)
+        results.current = i
+        self.goto_page(results.pages[i])
+        more = '' if results.done else '+'
+        first, last, total = results.matches(i)
+        if first == last:
+            return 'match {} of {}{}'.format(first, total, more)
+        return 'matches {}-{} of {}{}'.format(first, last, total, more)
+
+    def hit_rects(self, p, page):
+        # rectangles of the matches on page p for the current search,
+        # moved from the mediabox onto the page as it is cropped now
+        results = self.search
+        if results is None:
+            return ()
+        matrix = ~mediabox_matrix(page)
+        return tuple(tuple(fitz.Rect(rect) * matrix) for rect in results.hit_rects(page, p))
+
+    def start_cropping(self):
+        if not self.crop_boxes:
+            self.crop_boxes = Crop_Boxes(self)
+        self.crop_boxes.start()
+
+    def crop_page(self, page):
         if self.manualcrop and self.manualcroprect != [None,None] and self.is_pdf:
             page.set_cropbox(fitz.Rect(self.manualcroprect[0],self.manualcroprect[1]))
 
         elif self.autocrop and self.is_pdf:
             page.set_cropbox(page.mediabox)
-            crop = self.auto_crop(page)
+            if not self.crop_boxes:
+                self.crop_boxes = Crop_Boxes(self)
+            crop = self.crop_boxes.crop(page.number, page)
             page.set_cropbox(crop)
 
         elif self.is_pdf:
             page.set_cropbox(page.mediabox)
 
+    def prepare_page(self, p):
+        # load page, apply cropping, and calculate its zoom factor,
+        # its placement on the screen, and the size of its image
+        page = self.load_page(p)
+        self.crop_page(page)
+        return (page,) + self.fit_page(page.rect)
+
+    def fit_page(self, rect):
         dw = scr.width
         dh = scr.height - scr.cell_height
 
         if self.rotation in [0,180]:
-            pw = page.bound().width
-            ph = page.bound().height
+            pw = rect.width
+            ph = rect.height
         else:
-            pw = page.bound().height
-            ph = page.bound().width
+            pw = rect.height
+            ph = rect.width
         
         # calculate zoom factor
         fx = dw / pw
         fy = dh / ph
-        factor = min(fx,fy)
-        self.page_states[p].factor = factor
+        if self.fit != 'page':
+            # the page may be taller than the screen, and scroll
+            factor = fx
+        else:
+            factor = min(fx,fy)
     
         # calculate zoomed dimensions
         zw = factor * pw
         zh = factor * ph
+        mat = fitz.Matrix(factor, factor).prerotate(self.rotation)
+        size = (rect * mat).irect
 
         # calculate place in pixels, convert to cells
         pix_x = (dw / 2) - (zw / 2)
-        pix_y = (dh / 2) - (zh / 2)
+        pix_y = max(0, (dh / 2) - (zh / 2))
+        if self.fit == 'continuous':
+            # display_pages puts pages one below the other
+            pix_y = 0
         l_col = int(pix_x / scr.cell_width) + 1
         t_row = int(pix_y / scr.cell_height)
         r_col = l_col + int(zw / scr.cell_width)
-        b_row = t_row + int(zh / scr.cell_height)
+        b_row = t_row + int(min(zh, dh) / scr.cell_height)
         place = (l_col, t_row, r_col, b_row)
-        self.page_states[p].place = place
-
-        # move cursor to place
-        scr.set_cursor(l_col,t_row)
-
-        # clear previous page
-        # display image
-        cmd = {'a': 'p', 'i': p + 1, 'z': -1}
-        if page_state.stale: #or (display and not write_gr_cmd_with_response(cmd)):
-            # get zoomed and rotated pixmap
-            mat = fitz.Matrix(factor, factor)
-            mat = mat.prerotate(self.rotation)
-            pix = page.get_pixmap(matrix = mat, alpha=self.alpha)
-
-            if self.invert:
-                pix.invert_irect()
-
-            if self.tint:
-                tint = fitz.utils.getColor(self.tint_color)
-                red = int(tint[0] * 256)
-                blue = int(tint[1] * 256)
-                green = int(tint[2] * 256)
-                # pix.tint_with(red, blue, green)
-                # tinting disabled due to unresolved bug
-
-            # build cmd to send to kitty
-            cmd = {'i': p + 1, 't': 'd', 's': pix.width, 'v': pix.height}
-
-            if self.alpha:
-                cmd['f'] = 32
+
+        return factor, place, (size.width, size.height)
+
+    def estimate_rect(self, p):
+        # the rect of page p once crop_page has cropped it, as near as
+        # can be told without changing the page or measuring its crop
+        page = self.load_page(p)
+        if not self.is_pdf:
+            return page.rect
+        rect = page.mediabox
+        if self.manualcrop and self.manualcroprect != [None,None]:
+            rect = fitz.Rect(self.manualcroprect[0],self.manualcroprect[1])
+        elif self.autocrop and self.crop_boxes:
+            rect = self.crop_boxes.known_crop(p, page) or rect
+        if page.rotation % 180:
+            return fitz.Rect(0, 0, rect.height, rect.width)
+        return fitz.Rect(0, 0, rect.width, rect.height)
+
+    def get_page_stack(self):
+        stack = self.page_stack
+        if stack is None or stack.stale:
+            heights = []
+            for p in range(self.pages + 1):
+                _, _, size = self.fit_page(self.estimate_rect(p))
+                heights.append(size[1])
+            self.page_stack = Page_Stack(heights)
+            if stack is not None and self.scroll is not None:
+                # stay at the same place on the current page
+                into = (self.scroll - stack.tops[self.page]) / max(1, stack.heights[self.page])
+                into = min(max(into, 0), 1)
+                self.scroll = self.page_stack.tops[self.page] + int(into * heights[self.page])
             else:
-                cmd['f'] = 24
+                self.scroll = None
+        return self.page_stack
+
+    def page_scroll(self):
+        # how far down the current page's image the screen starts
+        if self.fit == 'width':
+            return self.scroll
+        elif self.fit == 'continuous':
+            return self.scroll - self.get_page_stack().tops[self.page]
+        return 0
+
+    def page_fingerprint(self, p):
+        # a hash of what page p draws, which stays the same when a
+        # recompiled document leaves the page unchanged
+        fingerprint = self.fingerprints[p]
+        if fingerprint is None:
+            if self.is_pdf:
+                page = self.load_page(p)
+                h = hashlib.blake2b(digest_size=16)
+                h.update(repr((tuple(page.mediabox), page.rotation)).encode())
+                # the page object, with its contents, resources and
+                # annotations; the crop box is left out, since we set
+                # it for display and the render key holds it anyway
+                source = self.xref_object(page.xref, compressed=True)
+                source = re.sub(r'/CropBox\s*\[[^\]]*\]', '', source)
+                h.update(self.object_source(source, set()))
+                # resources the page inherits from the page tree
+                xref = page.xref
+                resources = self.xref_get_key(xref, 'Resources')
+                while resources[0] == 'null':
+                    parent = self.xref_get_key(xref, 'Parent')
+                    if parent[0] != 'xref':
+                        break
+                    xref = int(parent[1].split()[0])
+                    resources = self.xref_get_key(xref, 'Resources')
+                if xref != page.xref:
+                    h.update(self.object_source(resources[1], set()))
+                fingerprint = h.hexdigest()
+            else:
+                fingerprint = '{}:{}:{}:{}'.format(self.filename, self.mtime, self.papersize, p)
+            self.fingerprints[p] = fingerprint
+        return fingerprint
+
+    def object_digest(self, xref, active):
+        # a hash of object xref and all it refers to, with references
+        # replaced by the hashes of their objects, so that it doesn't
+        # depend on where in the file the objects are; other pages are
+        # left out, so that links don't tie pages together
+        digest = self.object_digests.get(xref)
+        if digest is not None:
+            return digest
+        if (xref in active or not 0 < xref < self.xref_length()
+                or self.xref_get_key(xref, 'Type') == ('name', '/Page')):
+            return b'-'
+        active.add(xref)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.object_source(self.xref_object(xref, compressed=True), active))
+        if self.xref_is_stream(xref):
+            h.update(self.xref_stream_raw(xref) or b'')
+        active.discard(xref)
+        digest = h.digest()
+        self.object_digests[xref] = digest
+        return digest
+
+    def object_source(self, source, active):
+        # the source of an object, with its references hashed; the
+        # page tree, which holds every page, is left out
+        source = re.sub(r'/Parent\s+\d+\s+\d+\s+R\b', '', source)
+        return re.sub(r'\b(\d+)\s+\d+\s+R\b',
+                      lambda m: self.object_digest(int(m.group(1)), active).hex(),
+                      source).encode()
+
+    def render_key(self, p, page, factor, hits=()):
+        # everything that determines the pixels of a rendered page
+        crop = tuple(page.cropbox) if self.is_pdf else None
+        return (self.page_fingerprint(p), round(factor, 6), self.rotation,
+                crop, self.alpha,
+                color_filter.key(self.invert, self.tint_color if self.tint else None),
+                hits)
+
+    def get_rendered(self, key, page, factor, hits=()):
+        # rendered page from the cache, rendering it if needed
+        rendered = render_cache.get(key)
+        if rendered is None:
+            start = monotonic()
+            pix = self.render_page(page, factor, hits)
+            self.page_states[page.number].note_render(monotonic() - start,
+                                                      pix.width * pix.height)
+            rendered = Rendered(pix.width, pix.height, pix.alpha, pix.samples)
+            render_cache.put(key, rendered)
+        return rendered
+
+    def render_page(self, page, factor, hits=()):
+        # get zoomed and rotated pixmap
+        mat = fitz.Matrix(factor, factor)
+        mat = mat.prerotate(self.rotation)
+        pix = page.get_pixmap(matrix = mat, alpha=self.alpha)
+
+        # invert, tint, gamma, and contrast
+        color_filter.apply(pix, self.invert, self.tint_color if self.tint else None)
+
+        # highlight search hits by inverting them
+        for rect in hits:
+            pix.invert_irect((fitz.Rect(rect) * mat).irect & pix.irect)
+
+        return pix
+
+    def image_id(self, p):
+        return residency.image_id(self.filename, p)
+
+    def upload_page(self, p, rendered):
+        # build cmd to send to kitty
+        cmd = {'i': self.image_id(p), 's': rendered.width, 'v': rendered.height}
+
+        if rendered.alpha:
+            cmd['f'] = 32
+        else:
+            cmd['f'] = 24
+
+        # uploads are quiet, so the only response on stdin is the
+        # one to the placement
+        cmd['q'] = 2
+
+        # transfer the image
+        write_image(cmd, rendered.samples)
+
+    def load_image(self, p, preview=False, prefetch=False):
+        # make sure kitty holds an up to date image of page p,
+        # uploading it only if it doesn't; with preview, a page that
+        # is slow to render may get a low resolution image for now,
+        # which is rendered in full when shown, unless prefetching
+        page_state = self.page_states[p]
+        page, factor, place, size = self.prepare_page(p)
+        page_state.factor = factor
+        page_state.place = place
+        page_state.size = size
+        hits = self.hit_rects(p, page)
+        key = self.render_key(p, page, factor, hits)
+        image_id = self.image_id(p)
+        if residency.holds(image_id, key):
+            page_state.preview = False
+            return
+        if (preview and page_state.progressive and config.PROGRESSIVE_RENDER > 0
+                and key not in render_cache):
+            if self.load_preview(p, page, key, factor, hits, not prefetch):
+                return
+        rendered = self.get_rendered(key, page, factor, hits)
+        self.upload_page(p, rendered)
+        residency.add(image_id, key, len(rendered.samples))
+        page_state.preview = False
+
+    def load_preview(self, p, page, key, factor, hits, render=True):
+        # if page p is slow to render, upload a low resolution image
+        # of it, and, with render, render it in full in a worker
+        # process; False if rendering it here won't keep the viewer
+        # waiting long
+        page_state = self.page_states[p]
+        estimate = page_state.render_estimate()
+        if estimate is not None and estimate < config.PROGRESSIVE_RENDER:
+            return False
+        image_id = self.image_id(p)
+        preview_key = key + ('preview',)
+        if not residency.holds(image_id, preview_key):
+            start = monotonic()
+            pix = self.render_page(page, factor * self.preview_scale, hits)
+            if estimate is None:
+                # guess at the full render from the preview, which
+                # has preview_scale squared as many pixels
+                estimate = (monotonic() - start) / self.preview_scale ** 2
+                if estimate < config.PROGRESSIVE_RENDER:
+                    return False
+            rendered = Rendered(pix.width, pix.height, pix.alpha, pix.samples)
+            self.upload_page(p, rendered)
+            residency.add(image_id, preview_key, len(rendered.samples))
+        # kitty stretches the preview over the cells of the full image
+        page_state.preview = True
+        if render and not render_pool.pending(self, p):
+            render_pool.render(self, p, page, key, factor, hits)
+        return True
+
+    def scroll_limit(self, p):
+        # how far page p's image can scroll, in pixels
+        page_state = self.page_states[p]
+        return max(0, page_state.size[1] - (scr.height - scr.cell_height))
+
+    def scroll_by(self, pixels):
+        # scroll the page, turning to the next or previous page at
+        # the bottom or the top of this one
+        if self.fit == 'continuous':
+            return self.scroll_stack(pixels)
+        limit = self.scroll_limit(self.page)
+        if pixels > 0 and self.scroll >= limit:
+            self.next_page()
+        elif pixels < 0 and self.scroll <= 0 and self.page > 0:
+            self.prev_page()
+            # the bottom of the page, once its size is known
+            self.scroll = sys.maxsize
+        else:
+            self.scroll = min(max(self.scroll + pixels, 0), limit)
+
+    def scroll_stack(self, pixels):
+        # scroll through the stacked pages; the current page is the
+        # one at the top of the screen, or the last one at the end
+        stack = self.get_page_stack()
+        limit = max(0, stack.total - (scr.height - scr.cell_height))
+        if self.scroll is None:
+            self.scroll = stack.tops[self.page]
+        scroll = min(max(self.scroll + pixels, 0), limit)
+        if scroll == limit and pixels > 0:
+            p = self.pages
+        else:
+            p = stack.page_at(scroll)
+        if p != self.page:
+            self.goto_page(p)
+        self.scroll = scroll
+
+    def place_image(self, p, top=0, y=None):
+        # place page p's image at the cursor, showing it from its row
+        # of pixels top down, as far as the bottom of the screen; y is
+        # how far down the screen the image starts
+        cmd = {'a': 'p', 'i': self.image_id(p), 'p': 1, 'z': -1}
+        page_state = self.page_states[p]
+        l_col, t_row, r_col, _ = page_state.place
+        if y is None:
+            y = t_row * scr.cell_height
+        elif y % scr.cell_height:
+            # from the top of the cursor's cell
+            cmd['Y'] = y % scr.cell_height
+        width, height = page_state.size
+        height = min(height - top, scr.height - scr.cell_height - y)
+        if page_state.preview:
+            # kitty stretches the preview over the cells of the full image
+            cmd['c'] = r_col - l_col
+            cmd['r'] = max(1, int(height / scr.cell_height))
+            scale = self.preview_scale
+        else:
+            scale = 1
+        if self.fit != 'page':
+            # show the part of the image that the page is scrolled
+            # to, so that scrolling doesn't have to upload it again
+            cmd.update(x=0, y=int(top * scale), w=int(width * scale), h=int(height * scale))
+        return write_gr_cmd_with_response(cmd)
+
+    def prefetch_page(self, p):
+        # render and upload page p without displaying it, so that
+        # display_page only has to place it
+        with render_lock:
+            if bufs.docs[bufs.current] is not self or self.is_closed:
+                return
+            page_states = self.page_states
+            if p < 0 or p >= len(page_states) or not page_states[p].stale:
+                return
+            # rendering a heavy page here would hold up the viewer, so
+            # it gets only a preview, and stays stale, for display_page
+            # to have it rendered in full by the workers
+            self.load_image(p, preview=True, prefetch=True)
+            if not page_states[p].preview:
+                page_states[p].stale = False
 
-            # transfer the image
-            write_chunked(cmd, pix.samples)
+    def display_page(self, bar, p, display=True):
 
-        if display:  
-            # clear prevpage
-            self.clear_page(self.prevpage)
-            # display the image
-            cmd = {'a': 'p', 'i': p + 1, 'z': -1}
-            success = write_gr_cmd_with_response(cmd)
-            if not success:
-                self.page_states[p].stale = True
-                bar.message = 'failed to load page ' + str(p+1)
-                bar.update(self)
+        if self.fit == 'continuous' and display:
+            return self.display_pages(bar)
+
+        with render_lock:
+            page_state = self.page_states[p]
+            render_pool.follow(self, p)
+
+            if page_state.stale:
+                self.load_image(p, preview=True)
+
+            # move cursor to place
+            l_col, t_row, _, _ = page_state.place
+            scr.set_cursor(l_col,t_row)
+
+            if display:  
+                # clear prevpage, unless only the scroll has changed
+                if scr.placed != self.image_id(p):
+                    self.clear_page(self.prevpage)
+                top = 0
+                if self.fit == 'width':
+                    self.scroll = min(max(self.scroll, 0), self.scroll_limit(p))
+                    top = self.scroll
+                # display the image
+                residency.pin([self.image_id(p)])
+                success = self.place_image(p, top)
+                if not success:
+                    # kitty may have evicted the image; upload it again
+                    residency.forget(self.image_id(p))
+                    self.load_image(p, preview=True)
+                    scr.set_cursor(l_col,t_row)
+                    success = self.place_image(p, top)
+                if not success:
+                    page_state.stale = True
+                    bar.message = 'failed to load page ' + str(p+1)
+                    bar.update(self)
+                    return
+                scr.placed = self.image_id(p)
+
+            page_state.stale = False 
+
+    def display_pages(self, bar):
+        # show the stacked pages that are on screen, loading and
+        # placing only those
+        with render_lock:
+            render_pool.follow(self, self.page)
+            view = scr.height - scr.cell_height
+            stack = self.get_page_stack()
+            if self.scroll is None:
+                self.scroll = stack.tops[self.page]
+            resized = True
+            while resized:
+                self.scroll = min(max(self.scroll, 0), max(0, stack.total - view))
+                visible = stack.pages_between(self.scroll, self.scroll + view)
+                # loading one page on screen mustn't evict another
+                residency.pin([self.image_id(p) for p in visible])
+                resized = False
+                for p in visible:
+                    page_state = self.page_states[p]
+                    if page_state.stale:
+                        self.load_image(p, preview=(p == self.page))
+                        page_state.stale = False
+                    # the stack may have guessed its size wrong, e.g.
+                    # before its crop was measured
+                    top = stack.tops[p]
+                    grown = stack.resize(p, page_state.size[1])
+                    if grown:
+                        resized = True
+                        if top < self.scroll:
+                            self.scroll += grown
+
+            if scr.placed is not self:
+                # clear whatever else is on screen
+                self.clear_page(self.page)
+                self.stacked = set()
+                scr.placed = self
+            # take down the pages that have scrolled off
+            for p in self.stacked.difference(visible):
+                write_gr_cmd({'a': 'd', 'd': 'i', 'i': self.image_id(p), 'q': 2})
+            self.stacked = set(visible)
+
+            for p in visible:
+                y = stack.tops[p] - self.scroll
+                top = max(0, -y)
+                y = max(0, y)
+                l_col = self.page_states[p].place[0]
+                scr.set_cursor(l_col, y // scr.cell_height + 1)
+                success = self.place_image(p, top, y)
+                if not success:
+                    # kitty may have evicted the image; upload it again
+                    residency.forget(self.image_id(p))
+                    self.load_image(p)
+                    scr.set_cursor(l_col, y // scr.cell_height + 1)
+                    success = self.place_image(p, top, y)
+                if not success:
+                    self.page_states[p].stale = True
+                    bar.message = 'failed to load page ' + str(p+1)
+                    bar.update(self)
+
+    def thumbnail_path(self, p):
+        # thumbnails are cached for each version of the document, and
+        # each layout of a reflowable one
+        name = self.file_key
+        if self.is_reflowable:
+            name += '-{:g}x{:g}-{:g}'.format(*self.page_layout[2:])
+        path = os.path.join(get_cachedir(), 'thumbs', name)
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, '{}-{}.png'.format(p, config.THUMBNAIL_SIZE))
+
+    def remove_thumbnails(self):
+        # delete the thumbnails of this version of the document, in
+        # every layout, once a new version has replaced it
+        thumbs = os.path.join(get_cachedir(), 'thumbs')
+        try:
+            names = os.listdir(thumbs)
+        except OSError:
+            return
+        for name in names:
+            if name.split('-')[0] == self.file_key:
+                shutil.rmtree(os.path.join(thumbs, name), ignore_errors=True)
 
-        self.page_states[p].stale = False 
+    def show_thumbnails(self, bar):
+        # a grid of page thumbnails, rendered by render_pool as they
+        # come into view, for picking a page to go to
 
+        self.page_states[self.page].stale = True
+        self.clear_page(self.page)
+        scr.clear()
+        # quash stray escape codes
         scr.swallow_keys()
 
+        keys = shortcuts()
+        index = self.page
+        count = self.pages + 1
+        ready = set()
+        shown = {}
+        start = None
+
+        def layout():
+            # cells for each thumbnail, with a row for its label
+            cols = max(4, config.THUMBNAIL_SIZE // scr.cell_width)
+            rows = max(2, config.THUMBNAIL_SIZE // scr.cell_height) + 1
+            across = max(1, (scr.cols - 1) // (cols + 1))
+            down = max(1, (scr.rows - 1) // (rows + 1))
+            return cols, rows, across, down
+
+        def slot_id(i):
+            # image ids of their own, so the pages' images stay put
+            return self.thumbnail_ids + i
+
+        def take_down():
+            for i in shown:
+                write_gr_cmd({'a': 'd', 'd': 'I', 'i': slot_id(i), 'q': 2})
+            shown.clear()
+
+        def show(i, p, col, row, cols, rows):
+            path = self.thumbnail_path(p)
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the size of a png is in its header
+            width, height = struct.unpack('>II', data[16:24])
+            cmd = {'a': 'T', 'i': slot_id(i), 'f': 100, 'q': 2, 'z': -1}
+            # kitty keeps the aspect ratio when given only one side
+            if width * scr.cell_width * (rows - 1) > height * scr.cell_height * cols:
+                cmd['c'] = cols
+                used = cols
+            else:
+                cmd['r'] = rows - 1
+                used = int(width * (rows - 1) * scr.cell_height / (height * scr.cell_width))
+            scr.set_cursor(col + (cols - used) // 2, row)
+            if scr.transfer_medium == 'd':
+                write_image(cmd, data)
+            else:
+                # kitty reads the cached file itself
+                cmd['t'] = 'f'
+                write_gr_cmd(cmd, standard_b64encode(path.encode()))
+            shown[i] = p
+
+        while True:
+            cols, rows, across, down = layout()
+            per_screen = across * down
+            index = min(max(index, 0), count - 1)
+            if start != index - index % per_screen:
+                start = index - index % per_screen
+                take_down()
+                scr.clear()
+                ready.clear()
+                # this screenful first, then the next one
+                pages = range(start, min(start + 2 * per_screen, count))
+                missing = []
+                for p in pages:
+                    if os.path.exists(self.thumbnail_path(p)):
+                        ready.add(p)
+                    else:
+                        missing.append(p)
+                try:
+                    if missing:
+                        render_pool.render_thumbnails(self, missing, ready)
+                    else:
+                        render_pool.cancel()
+                except Exception:
+                    logging.exception('unable to start render workers')
+                    bar.message = 'unable to render thumbnails'
+                    break
+
+            for i in range(per_screen):
+                p = start + i
+                if p >= count:
+                    break
+                col = 2 + (i % across) * (cols + 1)
+                row = 1 + (i // across) * (rows + 1)
+                if shown.get(i) != p and p in ready:
+                    try:
+                        show(i, p, col, row, cols, rows)
+                    except (OSError, struct.error):
+                        logging.exception('unable to show thumbnail of page {}'.format(p + 1))
+                label = str(self.page_to_logical(p))[:cols]
+                scr.set_cursor(col + (cols - len(label)) // 2, row + rows - 1)
+                if p == index:
+                    sys.stdout.buffer.write(b'\033[7m')
+                sys.stdout.write(label)
+                sys.stdout.flush()
+                sys.stdout.buffer.write(b'\033[0m')
+            status = 'page {} of {}'.format(self.page_to_logical(index), self.page_to_logical(self.pages))
+            scr.place_string(1, scr.rows, status[:scr.cols - 1].ljust(scr.cols - 1))
+
+            # wake as thumbnails come in
+            key = wait_for_key(threading.Event())
+
+            if key in keys.REFRESH:
+                scr.clear()
+                scr.get_size()
+                scr.init_curses()
+                take_down()
+                start = None
+            elif key in keys.QUIT:
+                clean_exit()
+            elif key == 27 or key in keys.SHOW_THUMBNAILS:
+                break
+            elif key in [10, curses.KEY_ENTER]:
+                self.goto_page(index)
+                break
+            elif key in keys.NEXT_CHAP:
+                index += 1
+            elif key in keys.PREV_CHAP:
+                index -= 1
+            elif key in keys.SCROLL_DOWN:
+                index += across
+            elif key in keys.SCROLL_UP:
+                index -= across
+            elif key in keys.HALF_PAGE_DOWN or key == ord(' '):
+                index += per_screen
+            elif key in keys.HALF_PAGE_UP:
+                index -= per_screen
+            elif key in keys.GOTO_PAGE:
+                index = count - 1
+
+        render_pool.cancel()
+        take_down()
+        scr.clear()
+
     def show_toc(self, bar):
 
-        toc = self.get_toc()
+        toc = self.get_chapters()
 
         if not toc:
             bar.message = "No ToC available"
@@ -999,7 +3059,132 @@ class Page_State:
         self.stale = True
         self.factor = (1,1)
         self.place = (0,0,40,40)
+        self.size = (0,0)
         self.crop = None
+        # whether kitty holds a low resolution image
+        self.preview = False
+        self.progressive = True
+        # seconds per megapixel the last full render took
+        self.render_cost = None
+
+    def note_render(self, seconds, pixels):
+        self.render_cost = seconds * 1e6 / max(1, pixels)
+
+    def render_estimate(self):
+        # seconds a full render at the current size should take, going
+        # by the last one, or None if the page hasn't been rendered
+        if self.render_cost is None:
+            return None
+        return self.render_cost * self.size[0] * self.size[1] / 1e6
+
+class Prefetcher:
+    """
+    Renders and uploads the pages around the current page in a
+    background thread, following the direction of paging
+    """
+    def __init__(self):
+        self.doc = None
+        self.wanted = threading.Event()
+        self.thread = None
+
+    def schedule(self, doc):
+        if config.PREFETCH_DEPTH < 1:
+            return
+        self.doc = doc
+        self.wanted.set()
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def pages_to_fetch(self, doc):
+        depth = config.PREFETCH_DEPTH
+        d = doc.direction
+        ahead = [doc.page + d * i for i in range(1, depth + 1)]
+        behind = [doc.page - d * i for i in range(1, depth // 2 + 1)]
+        return [p for p in ahead + behind if 0 <= p <= doc.pages]
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            doc = self.doc
+            for p in self.pages_to_fetch(doc):
+                # start over if the viewer has moved on
+                if self.wanted.is_set():
+                    break
+                try:
+                    doc.prefetch_page(p)
+                except Exception:
+                    logging.exception('prefetch of page {} failed'.format(p))
+                    break
+            else:
+                wakeup.wake(Wakeup.RENDERED)
+
+class Wakeup:
+    """
+    A self-pipe that lets signal handlers and background threads wake
+    the viewer while it waits for input
+    """
+    FILE_CHANGE = b'f'
+    RESIZE = b'w'
+    RENDERED = b'r'
+    SEARCH = b's'
+    RELAYOUT = b'l'
+    REDRAW = b'd'
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        os.set_blocking(self.r, False)
+        os.set_blocking(self.w, False)
+
+    def wake(self, reason):
+        try:
+            os.write(self.w, reason)
+        except BlockingIOError:
+            # the pipe is full, so the viewer will wake anyway
+            pass
+
+    def drain(self):
+        events = b''
+        while True:
+            try:
+                data = os.read(self.r, 512)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            events += data
+        return events
+
+class Latency:
+    """
+    Time from reading a key to finishing the paint it caused
+    """
+    def __init__(self):
+        self.start = None
+        self.last = 0
+        self.worst = 0
+        self.total = 0
+        self.count = 0
+
+    def key_read(self):
+        self.start = monotonic()
+
+    def painted(self):
+        if self.start is None:
+            return
+        self.last = monotonic() - self.start
+        self.start = None
+        self.worst = max(self.worst, self.last)
+        self.total += self.last
+        self.count += 1
+        logging.debug('input to paint: {:.1f} ms'.format(self.last * 1000))
+
+    def stats(self):
+        mean = self.total / self.count if self.count else 0
+        return 'paint: last {:.0f} ms, mean {:.0f} ms, max {:.0f} ms'.format(
+                self.last * 1000, mean * 1000, self.worst * 1000)
 
 class status_bar:
 
@@ -1040,6 +3225,7 @@ class shortcuts:
         self.HINTS            = [ord('f')]
         self.OPEN             = [curses.KEY_ENTER, curses.KEY_RIGHT, 10]
         self.SHOW_TOC         = [ord('t')]
+        self.SHOW_THUMBNAILS  = [ord('o')]
         self.SHOW_META        = [ord('M')]
         self.UPDATE_FROM_BIB  = [ord('b')]
         self.SHOW_LINKS       = [ord('f')]
@@ -1052,6 +3238,12 @@ class shortcuts:
         self.INSERT_NOTE      = [ord('n')]
         self.APPEND_NOTE      = [ord('a')]
         self.TOGGLE_AUTOCROP  = [ord('c')]
+        self.TOGGLE_UNIFORM_CROP = [ord('C')]
+        self.TOGGLE_FIT       = [ord('w')]
+        self.SCROLL_DOWN      = [ord('j'), curses.KEY_DOWN]
+        self.SCROLL_UP        = [ord('k'), curses.KEY_UP]
+        self.HALF_PAGE_DOWN   = [4]                                # CTRL-D
+        self.HALF_PAGE_UP     = [21]                               # CTRL-U
         self.TOGGLE_ALPHA     = [ord('A')]
         self.TOGGLE_INVERT    = [ord('i')]
         self.TOGGLE_TINT      = [ord('d')]
@@ -1062,6 +3254,9 @@ class shortcuts:
         self.OPEN_GUI         = [ord('X')]
         self.REFRESH          = [18, curses.KEY_RESIZE]            # CTRL-R
         self.QUIT             = [3, ord('q')]
+        self.NEXT_HIT         = [ord('n')]
+        self.PREV_HIT         = [ord('N')]
+        self.SEARCH_ALL       = [ord('?')]
         self.DEBUG            = [ord('D')]
 
 # Kitty graphics functions
@@ -1084,18 +3279,173 @@ def write_gr_cmd(cmd, payload=None):
     sys.stdout.buffer.write(serialize_gr_command(cmd, payload))
     sys.stdout.flush()
 
-def write_gr_cmd_with_response(cmd, payload=None):
-    # rewrite using swallow keys to be nonblocking
+class Graphics_Responses:
+    """
+    Reads kitty's responses to graphics commands from stdin without
+    blocking, matches them to image ids, and hands any keys typed in
+    the meantime back to curses
+    """
+    def __init__(self):
+        self.buffer = b''
+        self.keys = b''
+        self.responses = {}
+
+    def read(self, timeout):
+        fd = sys.stdin.fileno()
+        ready, _, _ = select.select([fd], [], [], max(timeout, 0))
+        if ready:
+            self.buffer += os.read(fd, 4096)
+        self.parse()
+
+    def parse(self):
+        start_code = b'\033_G'
+        while True:
+            start = self.buffer.find(start_code)
+            if start == -1:
+                # anything that can't be the start of a response is input
+                keep = 0
+                for i in range(1, len(start_code)):
+                    if self.buffer.endswith(start_code[:i]):
+                        keep = i
+                split = len(self.buffer) - keep
+                self.keys += self.buffer[:split]
+                self.buffer = self.buffer[split:]
+                return
+            self.keys += self.buffer[:start]
+            end = self.buffer.find(b'\033\\', start)
+            if end == -1:
+                # wait for the rest of the response
+                self.buffer = self.buffer[start:]
+                return
+            response = self.buffer[start + len(start_code):end]
+            self.buffer = self.buffer[end + 2:]
+            control, _, message = response.partition(b';')
+            image_id = 0
+            for item in control.split(b','):
+                k, _, v = item.partition(b'=')
+                if k == b'i' and v.isdigit():
+                    image_id = int(v)
+            self.responses[image_id] = message.decode('ascii', 'replace')
+
+    def expect(self, image_id):
+        # forget any late response to an earlier command with this id
+        self.responses.pop(image_id, None)
+
+    def wait_for(self, image_id, timeout=2):
+        end = monotonic() + timeout
+        while image_id not in self.responses:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                break
+            self.read(remaining)
+        if self.buffer and not self.buffer.startswith(b'\033_G'):
+            # a lone escape is a keypress, not a response
+            self.keys += self.buffer
+            self.buffer = b''
+        self.return_keys()
+        return self.responses.pop(image_id, None)
+
+    def return_keys(self):
+        # curses.ungetch pushes onto a stack, so push in reverse
+        for c in reversed(self.keys):
+            curses.ungetch(c)
+        self.keys = b''
+
+def write_gr_cmd_with_response(cmd, payload=None, timeout=2):
+    image_id = cmd.get('i', 0)
+    gr_responses.expect(image_id)
     write_gr_cmd(cmd, payload)
-    resp = b''
-    while resp[-2:] != b'\033\\':
-        resp += sys.stdin.buffer.read(1)
-    if b'OK' in resp:
+    response = gr_responses.wait_for(image_id, timeout)
+    if response and response.startswith('OK'):
         return True
     else:
+        if response:
+            logging.debug('kitty: ' + response)
         return False
 
 
+def write_shm(data):
+    # copy data into a POSIX shared memory object, and return its name;
+    # kitty unlinks the object once it has read it
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=len(data), track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.buf[:len(data)] = data
+    name = shm.name
+    shm.close()
+    if not name.startswith('/'):
+        name = '/' + name
+    return name
+
+def unlink_shm(name):
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(name=name.lstrip('/'))
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+def write_tempfile(data):
+    # kitty only deletes temporary files whose names contain
+    # tty-graphics-protocol
+    with NamedTemporaryFile(prefix='tty-graphics-protocol-', delete=False) as f:
+        f.write(data)
+    return f.name
+
+def detect_transfer_mode():
+    # probe, once, for the fastest way of getting images to kitty;
+    # shared memory and temporary files only work when kitty runs on
+    # the same machine as termpdf.py
+    mode = config.TRANSFER_MODE
+    if mode == 'direct':
+        return 'd'
+    if mode == 'auto' and (os.getenv('SSH_CONNECTION') or os.getenv('SSH_TTY')):
+        return 'd'
+    # send both probes before waiting for either response
+    name = path = None
+    if mode in ['auto', 'shm']:
+        try:
+            name = write_shm(b'abc')
+        except Exception:
+            name = None
+        if name:
+            gr_responses.expect(31)
+            cmd = {'a': 'q', 'i': 31, 's': 1, 'v': 1, 'f': 24, 't': 's'}
+            write_gr_cmd(cmd, standard_b64encode(name.encode()))
+    if mode in ['auto', 'file']:
+        path = write_tempfile(b'abc')
+        gr_responses.expect(32)
+        cmd = {'a': 'q', 'i': 32, 's': 1, 'v': 1, 'f': 24, 't': 't'}
+        write_gr_cmd(cmd, standard_b64encode(path.encode()))
+    shm_ok = name and gr_responses.wait_for(31) == 'OK'
+    file_ok = path and gr_responses.wait_for(32) == 'OK'
+    if name and not shm_ok:
+        unlink_shm(name)
+    if path and os.path.exists(path):
+        os.remove(path)
+    if shm_ok:
+        return 's'
+    elif file_ok:
+        return 't'
+    return 'd'
+
+def write_image(cmd, data):
+    # send image data using the medium chosen by detect_transfer_mode
+    medium = scr.transfer_medium
+    if medium == 's':
+        cmd['t'] = 's'
+        write_gr_cmd(cmd, standard_b64encode(write_shm(data).encode()))
+    elif medium == 't':
+        cmd['t'] = 't'
+        write_gr_cmd(cmd, standard_b64encode(write_tempfile(data).encode()))
+    else:
+        cmd['t'] = 'd'
+        write_chunked(cmd, data)
+
 def write_chunked(cmd, data):
     if cmd['f'] != 100:
         data = zlib.compress(data)
@@ -1154,21 +3504,39 @@ def path_from_citekey(citekey):
             paths = bib.entries[citekey].fields["File"]
         except:
             raise SystemExit('No file for ' + citekey)
-        paths = paths.split(';')
-        exts = ['.pdf', '.xps', '.cbz', '.fb2' ]
-        extsf = ['.epub', '.oxps']
-        extsl = ['.html']
-        best = [path for path in paths if path[-4:] in exts]
-        okay = [path for path in paths if path[-5:] in extsf]
-        worst = [path for path in paths if path[-5:] in extsl]
-        if len(best) != 0:
-            return best[0]
-        elif len(okay) != 0:
-            return okay[0]
-        elif len(worst) != 0:
-            return worst[0]
+        return path_from_field(paths)
     return None
 
+def path_from_field(paths):
+    # the best of the files in a bibtex File field
+    paths = paths.split(';')
+    exts = ['.pdf', '.xps', '.cbz', '.fb2' ]
+    extsf = ['.epub', '.oxps']
+    extsl = ['.html']
+    best = [path for path in paths if path[-4:] in exts]
+    okay = [path for path in paths if path[-5:] in extsf]
+    worst = [path for path in paths if path[-5:] in extsl]
+    if len(best) != 0:
+        return best[0]
+    elif len(okay) != 0:
+        return okay[0]
+    elif len(worst) != 0:
+        return worst[0]
+    return None
+
+def library_files():
+    # (citekey, path) of every file in the bibtex library
+    from pybtex.database import parse_file
+    bib = parse_file(config.BIBTEX,'bibtex')
+    files = []
+    for citekey, entry in bib.entries.items():
+        if 'File' not in entry.fields:
+            continue
+        path = path_from_field(entry.fields['File'])
+        if path and os.path.isfile(path):
+            files.append((citekey, path))
+    return files
+
 # Command line helper functions
 
 def print_version():
@@ -1267,11 +3635,18 @@ def clean_exit(message=''):
     
     scr.create_text_win(1, ' ')
 
-    for doc in bufs.docs:
-        # save current state
-        doc.write_state()
-        # close the document
-        doc.close()
+    with render_lock:
+        # save edited page labels and current state
+        for doc in bufs.docs:
+            doc.write_pagelabels()
+        state_store.save_many(bufs.docs)
+        for doc in bufs.docs:
+            # close the document
+            doc.close()
+        # free the images kitty holds for us
+        residency.clear()
+    search_pool.close()
+    render_pool.close()
 
     # close curses
     scr.stdscr.keypad(False)
@@ -1480,15 +3855,341 @@ def visual_mode(doc,bar):
             doc.mark_all_pages_stale()
             return
 
-def watch_for_file_change(file_change,path):
-    timestamp = os.path.getmtime(path)
+class File_Watcher:
+    """
+    Watches the files of all open buffers, with inotify where it is
+    available and by polling otherwise. Changes are only reported once
+    the file has stopped changing, so half-written files are skipped.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.paths = {}
+        self.pending = {}
+        self.changed = set()
+        self.dirs = {}
+        self.inotify = None
+        self.libc = None
+        self.thread = None
+        self.debounce = 0.1
+
+    def signature(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def init_inotify(self):
+        if not sys.platform.startswith('linux'):
+            return
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.libc = libc
+            self.inotify = fd
+
+    def watch(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.paths:
+                return
+            self.paths[path] = self.signature(path)
+        # watch the directory, so that saves that replace the file
+        # by renaming another one over it are seen too
+        if self.inotify is not None:
+            d = os.path.dirname(path)
+            if d not in self.dirs.values():
+                mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE
+                        | self.IN_MOVED_TO | self.IN_CREATE)
+                wd = self.libc.inotify_add_watch(self.inotify, d.encode(), mask)
+                if wd >= 0:
+                    self.dirs[wd] = d
+
+    def ignore(self, path):
+        # take the current version of path as seen, after we change
+        # it ourselves
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.paths:
+                self.paths[path] = self.signature(path)
+
+    def unwatch(self, path):
+        with self.lock:
+            self.paths.pop(os.path.abspath(path), None)
+
+    def start(self):
+        self.init_inotify()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_events(self):
+        # names of the files in our directories that inotify saw change
+        import struct
+        try:
+            data = os.read(self.inotify, 65536)
+        except BlockingIOError:
+            return []
+        paths = []
+        i = 0
+        while i + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+            name = data[i + 16:i + 16 + length].rstrip(b'\0').decode(errors='replace')
+            i += 16 + length
+            if wd in self.dirs:
+                paths.append(os.path.join(self.dirs[wd], name))
+        return paths
+
+    def poll(self):
+        with self.lock:
+            paths = list(self.paths)
+        return [path for path in paths if self.signature(path) != self.paths.get(path)]
+
+    def settle(self):
+        # report pending files whose size and mtime have stopped changing
+        now = monotonic()
+        for path, (sig, since) in list(self.pending.items()):
+            new = self.signature(path)
+            if new != sig:
+                self.pending[path] = (new, now)
+            elif new is not None and new[1] > 0 and now - since >= self.debounce:
+                del self.pending[path]
+                with self.lock:
+                    if path not in self.paths or self.paths[path] == new:
+                        continue
+                    self.paths[path] = new
+                    self.changed.add(path)
+                logging.debug('file changed: ' + path)
+                self.event.set()
+                wakeup.wake(Wakeup.FILE_CHANGE)
+
+    def run(self):
+        while True:
+            if self.inotify is not None:
+                timeout = self.debounce / 2 if self.pending else None
+                ready, _, _ = select.select([self.inotify], [], [], timeout)
+                changed = self.read_events() if ready else []
+            else:
+                sleep(self.debounce / 2 if self.pending else .5)
+                changed = self.poll()
+            for path in changed:
+                if path in self.paths and path not in self.pending:
+                    self.pending[path] = (self.signature(path), monotonic())
+            self.settle()
+
+    def take_changes(self):
+        with self.lock:
+            changed = self.changed
+            self.changed = set()
+            self.event.clear()
+        return changed
+
+def reload_buffer(n, keep_pages=True):
+    # reopen buffer n from disk, carrying its state over; pages
+    # whose content hasn't changed keep their renders and uploads
+    old = bufs.docs[n]
+    # labels still waiting to be saved would be lost with the old
+    # document, so write them first, for the new one to read
+    old.write_pagelabels()
+    doc = Document(old.filename)
+    for key, value in old.state().items():
+        setattr(doc, key, value)
+    doc.set_layout(doc.papersize,adjustpage=False)
+    doc.goto_logical_page(doc.logicalpage)
+    with render_lock:
+        kept = 0
+        if keep_pages:
+            for p, page_state in enumerate(old.page_states[:doc.pages + 1]):
+                if page_state.stale:
+                    continue
+                try:
+                    unchanged = old.page_fingerprint(p) == doc.page_fingerprint(p)
+                except Exception:
+                    # the old file may have been overwritten in place
+                    unchanged = False
+                if unchanged:
+                    doc.page_states[p] = page_state
+                    kept += 1
+        if not keep_pages:
+            # a refresh starts over, rendering and uploading every
+            # page again, in case kitty shows one wrong
+            render_cache.discard(f for f in old.fingerprints if f)
+            residency.drop(old.filename)
+        if old.crop_boxes and doc.is_pdf:
+            # pages the new version leaves unchanged keep their crops
+            doc.crop_boxes = Crop_Boxes(doc, old.crop_boxes.by_fingerprint())
+        if old.file_key != doc.file_key:
+            state_store.replace(old.file_key, doc.file_key)
+            old.remove_thumbnails()
+        logging.debug('reloaded {}, kept {} pages'.format(doc.filename, kept))
+        bufs.docs[n] = doc
+        old.close()
+    return doc
+
+def open_buffer(path, citekey=None):
+    # open path in a new buffer, or return its buffer if it is open
+    for n, doc in enumerate(bufs.docs):
+        if os.path.abspath(doc.filename) == os.path.abspath(path):
+            return n
+    doc = Document(path)
+    state = state_store.load(doc.filename) or {}
+    for key in state:
+        setattr(doc, key, state[key])
+    doc.citekey = doc.citekey or citekey
+    bufs.docs += [doc]
+    watcher.watch(doc.filename)
+    return len(bufs.docs) - 1
+
+def search_all(doc, bar):
+    # search every buffer, and the bibtex library if SEARCH_LIBRARY is
+    # set, and list the hits; returns the document to view
+
+    scr.place_string(1,scr.rows,"?")
+    curses.echo()
+    scr.set_cursor(2,scr.rows)
+    s = scr.stdscr.getstr()
+    curses.noecho()
+    query = s.decode('utf-8').strip()
+    if not query:
+        return doc
+    try:
+        re.compile(query)
+    except re.error:
+        bar.message = 'invalid pattern'
+        return doc
+
+    library = bool(config.SEARCH_LIBRARY and config.BIBTEX)
+    results = Library_Results(query, library)
+    targets = [(d.filename, d.citekey, d) for d in bufs.docs]
+    try:
+        search_pool.search_files(targets, results)
+    except Exception:
+        logging.exception('unable to start search workers')
+        bar.message = 'unable to search'
+        return doc
+
+    doc.page_states[doc.page].stale = True
+    doc.clear_page(doc.page)
+    scr.clear()
+    # quash stray escape codes
+    scr.swallow_keys()
+
+    def init_pad(hits):
+        header = 'Search: {}'.format(query)
+        win, pad = scr.create_text_win(max(len(hits), 1), header)
+        y,x = win.getbegyx()
+        h,w = win.getmaxyx()
+        span = []
+        for i, hit in enumerate(hits):
+            _, name, _, label, snippet, _ = hit
+            text = '{:<20} {:>6}  {}'.format(name[:20], label, snippet)
+            text = text[:w - 5]
+            pad.addstr(i,0,text)
+            span.append(len(text))
+        return win,pad,y,x,h,w,span
+
+    keys = shortcuts()
+    index = 0
+    j = 0
+    shown = None
+
     while True:
-        sleep(.5)
-        nts = os.path.getmtime(path)
-        if nts != timestamp:
-            timestamp = nts
-            logging.debug('file changed')
-            file_change.set() 
+        hits = list(results.hits)
+        if len(hits) != shown:
+            win,pad,y,x,h,w,span = init_pad(hits)
+            shown = len(hits)
+        status = '{} matches in {} of {} files'.format(len(hits), results.searched, results.files)
+        if not results.done:
+            status += '...'
+        win.addstr(h - 2, 2, status[:w - 4])
+        win.refresh()
+        for i in range(len(hits)):
+            attr = curses.A_REVERSE if index == i else curses.A_NORMAL
+            pad.chgat(i, 0, span[i], attr)
+        pad.refresh(j, 0, y + 3, x + 2, y + h - 4, x + w - 3)
+
+        # wake as hits come in, leaving file changes for the viewer
+        key = wait_for_key(threading.Event())
+
+        if key in keys.REFRESH:
+            scr.clear()
+            scr.get_size()
+            scr.init_curses()
+            shown = None
+        elif key in keys.QUIT:
+            clean_exit()
+        elif key == 27 or key in keys.SEARCH_ALL:
+            search_pool.cancel()
+            scr.clear()
+            return doc
+        elif key in keys.NEXT_PAGE:
+            index = min(len(hits) - 1, index + 1)
+        elif key in keys.PREV_PAGE:
+            index = max(0, index - 1)
+        elif key in keys.OPEN and hits:
+            search_pool.cancel()
+            scr.clear()
+            _, name, p, _, _, path = hits[index]
+            try:
+                n = open_buffer(path, None if name == os.path.basename(path) else name)
+            except Exception:
+                logging.exception('unable to open ' + path)
+                bar.message = 'unable to open ' + path
+                return doc
+            bufs.goto_buffer(n)
+            doc = bufs.docs[n]
+            doc.pages_to_logical_pages()
+            doc.set_layout(doc.papersize,adjustpage=False)
+            doc.mark_all_pages_stale()
+            doc.goto_page(p)
+            # show the hits on the page
+            bar.message = doc.search_text(query)
+            return doc
+
+        if index > j + (h - 7):
+            j += 1
+        if index < j:
+            j -= 1
+
+def wait_for_key(file_change):
+    # sleep until a key is pressed, the file changes, or the window
+    # is resized, instead of polling getch
+    fd = sys.stdin.fileno()
+    scr.stdscr.nodelay(True)
+    try:
+        while True:
+            # curses may already hold keys, e.g. ones handed back
+            # by gr_responses
+            key = scr.stdscr.getch()
+            if key != -1:
+                latency.key_read()
+                return key
+            if file_change.is_set():
+                return -1
+            ready, _, _ = select.select([fd, wakeup.r], [], [])
+            if wakeup.r in ready:
+                events = wakeup.drain()
+                if Wakeup.RESIZE in events:
+                    latency.key_read()
+                    return curses.KEY_RESIZE
+                if any(event in events for event in
+                       [Wakeup.SEARCH, Wakeup.RELAYOUT, Wakeup.REDRAW]):
+                    return -1
+    finally:
+        scr.stdscr.nodelay(False)
 
 def view(file_change,doc):
 
@@ -1499,6 +4200,7 @@ def view(file_change,doc):
         raise SystemExit(
             'Terminal does not support kitty graphics protocol'
             )
+    scr.transfer_medium = detect_transfer_mode()
     scr.swallow_keys()
 
     bar = status_bar()
@@ -1511,25 +4213,40 @@ def view(file_change,doc):
 
     while True:
 
+        doc.apply_layout()
+        message = doc.update_search()
+        if message:
+            bar.message = message
         bar.cmd = ''.join(map(chr,stack[::-1]))
         bar.update(doc )
         doc.display_page(bar,doc.page)
+        latency.painted()
+        prefetcher.schedule(doc)
+        doc.start_indexing()
+        if doc.autocrop and doc.is_pdf:
+            doc.start_cropping()
 
         if count_string == "":
             count = 1
         else:
             count = int(count_string)
         
-        scr.stdscr.nodelay(True)
-        key = scr.stdscr.getch()
-        while key == -1 and not file_change.is_set():
-            key = scr.stdscr.getch()
-        scr.stdscr.nodelay(False)
+        key = wait_for_key(file_change)
 
         if file_change.is_set():
             logging.debug('view thread sees that file has changed')
-            key = keys.REFRESH[0]
-            file_change.clear()
+            changed = watcher.take_changes()
+            for n, d in enumerate(bufs.docs):
+                if os.path.abspath(d.filename) not in changed:
+                    continue
+                try:
+                    d = reload_buffer(n)
+                except Exception:
+                    # leave the old version up, and try again on the next change
+                    logging.exception('unable to reload ' + d.filename)
+                    continue
+                if n == bufs.current:
+                    doc = d
 
         if key == -1:
             pass
@@ -1538,25 +4255,13 @@ def view(file_change,doc):
             scr.clear()
             scr.get_size()
             scr.init_curses()
-            current_doc = bufs.docs[bufs.current]
-            current_doc.write_state()
-            doc = Document(current_doc.filename)
-            cachefile = get_cachefile(doc.filename)
-            if os.path.exists(cachefile):
-                with open(cachefile, 'r') as f:
-                    state = json.load(f)
-                for key in state:
-                    setattr(doc, key, state[key])
-            bufs.docs[bufs.current] = doc
-            if not doc.citekey:
-                doc.citekey = citekey_from_path(doc.filename)
-            doc.pages_to_logical_pages()
-            doc.goto_logical_page(doc.logicalpage)
-            doc.set_layout(doc.papersize,adjustpage=False)
+            doc = reload_buffer(bufs.current, keep_pages=False)
 
         elif key == 27:
             # quash stray escape codes
             scr.swallow_keys()
+            # and end the current search
+            doc.end_search()
             count_string = ""
             stack = [0]
 
@@ -1620,6 +4325,25 @@ def view(file_change,doc):
             count_string = ""
             stack = [0]
 
+        elif key in keys.SCROLL_DOWN and doc.fit != 'page':
+            doc.scroll_by(count * config.SCROLL_ROWS * scr.cell_height)
+            count_string = ""
+            stack = [0]
+
+        elif key in keys.SCROLL_UP and doc.fit != 'page':
+            doc.scroll_by(-count * config.SCROLL_ROWS * scr.cell_height)
+            count_string = ""
+            stack = [0]
+
+        elif key in keys.HALF_PAGE_DOWN + keys.HALF_PAGE_UP:
+            direction = 1 if key in keys.HALF_PAGE_DOWN else -1
+            if doc.fit != 'page':
+                doc.scroll_by(direction * count * (scr.height - scr.cell_height) // 2)
+            else:
+                doc.goto_page(doc.page + direction * count)
+            count_string = ""
+            stack = [0]
+
         elif key in keys.NEXT_PAGE:
             doc.next_page(count)
             count_string = ""
@@ -1680,6 +4404,25 @@ def view(file_change,doc):
             count_string = ""
             stack = [0]
 
+        elif key in keys.TOGGLE_FIT:
+            doc.fit = {'page': 'width', 'width': 'continuous'}.get(doc.fit, 'page')
+            doc.scroll = None if doc.fit == 'continuous' else 0
+            bar.message = {'page': 'fit page', 'width': 'fit width',
+                           'continuous': 'continuous pages'}[doc.fit]
+            doc.mark_all_pages_stale()
+            count_string = ""
+            stack = [0]
+
+        elif key in keys.TOGGLE_UNIFORM_CROP:
+            doc.autocrop_uniform = not doc.autocrop_uniform
+            if doc.autocrop_uniform:
+                bar.message = 'uniform crop on odd and even pages'
+            else:
+                bar.message = 'crop each page to its margins'
+            doc.mark_all_pages_stale()
+            count_string = ""
+            stack = [0]
+
         elif key in keys.TOGGLE_ALPHA:
             doc.alpha = not doc.alpha
             doc.mark_all_pages_stale()
@@ -1698,6 +4441,11 @@ def view(file_change,doc):
             count_string = ""
             stack = [0]
 
+        elif key in keys.SHOW_THUMBNAILS:
+            doc.show_thumbnails(bar)
+            count_string = ""
+            stack = [0]
+
         elif key in keys.SHOW_TOC:
             doc.show_toc(bar)
             count_string = ""
@@ -1719,14 +4467,14 @@ def view(file_change,doc):
             stack = [0]
        
         elif key in keys.INC_FONT:
-            doc.set_layout(doc.papersize - count)
-            doc.mark_all_pages_stale()
+            if doc.is_reflowable:
+                bar.message = doc.request_layout(doc.papersize - count)
             count_string = ""
             stack = [0]
         
         elif key in keys.DEC_FONT:
-            doc.set_layout(doc.papersize + count)
-            doc.mark_all_pages_stale()
+            if doc.is_reflowable:
+                bar.message = doc.request_layout(doc.papersize + count)
             count_string = ""
             stack = [0]
 
@@ -1735,6 +4483,21 @@ def view(file_change,doc):
             count_string = ""
             stack = [0]
 
+        elif key in keys.NEXT_HIT and doc.search:
+            bar.message = doc.goto_hit(count)
+            count_string = ""
+            stack = [0]
+
+        elif key in keys.PREV_HIT and doc.search:
+            bar.message = doc.goto_hit(-count)
+            count_string = ""
+            stack = [0]
+
+        elif key in keys.SEARCH_ALL:
+            doc = search_all(doc, bar)
+            count_string = ""
+            stack = [0]
+
         elif key in keys.INSERT_NOTE:
             text = doc.make_link()
             doc.send_to_neovim(text,append=False)
@@ -1777,12 +4540,19 @@ def view(file_change,doc):
             subprocess.run([config.GUI_VIEWER, doc.filename], check=True)
 
         elif key in keys.DEBUG:
-            pass
+            bar.message = '; '.join([latency.stats(), render_cache.stats(), color_filter.stats(),
+                                     residency.stats()])
 
         elif key in range(48,257): #printable characters
             stack = [key] + stack
 
 
+# MuPDF and the terminal are shared by the viewer and background threads
+render_lock = threading.RLock()
+# file digests are global
+file_identity = File_Identity()
+# document state store is global
+state_store = State_Store()
 # config is global
 config = Config()
 config.load_config_file()
@@ -1792,6 +4562,26 @@ if not config.URL_BROWSER:
 bufs = Buffers()
 # screen is global
 scr = Screen()
+# prefetcher is global
+prefetcher = Prefetcher()
+# render cache is global
+render_cache = Render_Cache()
+# post-processing of rendered pages is global
+color_filter = Color_Filter()
+# record of images held by kitty is global
+residency = Residency()
+# kitty's responses are global
+gr_responses = Graphics_Responses()
+# wakeup pipe for the viewer is global
+wakeup = Wakeup()
+# input latency measurements are global
+latency = Latency()
+# file watcher is global
+watcher = File_Watcher()
+# search workers are global
+search_pool = Search_Pool()
+# render workers are global
+render_pool = Render_Pool()
 
 def main(args=sys.argv):
 
@@ -1810,20 +4600,24 @@ def main(args=sys.argv):
 
     paths, opts = parse_args(args)
 
+    # wake the viewer on resize; this must be set up in the main thread,
+    # and replaces curses' own handler
+    signal.signal(signal.SIGWINCH, lambda signum, frame: wakeup.wake(Wakeup.RESIZE))
+
     for path in paths:
         try:
             doc = Document(path)
         except:
-            raise SystemExit('Unable to open ' + files[0])
+            raise SystemExit('Unable to open ' + path)
+        bufs.docs += [doc]
 
-        # load saved file state
-        cachefile = get_cachefile(doc.filename)
-        if os.path.exists(cachefile) and not opts['ignore_cache']:
-            with open(cachefile, 'r') as f:
-                state = json.load(f)
+    # load saved file state
+    if not opts['ignore_cache']:
+        states = state_store.load_many([doc.filename for doc in bufs.docs])
+        for doc in bufs.docs:
+            state = states.get(doc.filename, {})
             for key in state:
                 setattr(doc, key, state[key])
-        bufs.docs += [doc]
 
     for doc in bufs.docs:
         if not doc.citekey:
@@ -1835,22 +4629,20 @@ def main(args=sys.argv):
     for key in opts:
         setattr(doc, key, opts[key])
 
-    # generate logical pages
-    doc.pages_to_logical_pages()
+    # apply layout settings, which saved page numbers depend on
+    doc.set_layout(doc.papersize,adjustpage=False)
 
     # normalize page number
     doc.goto_logical_page(doc.logicalpage)
 
-    # apply layout settings
-    doc.set_layout(doc.papersize,adjustpage=False)
-
     # set up thread to watch for file changes
-    file_change = threading.Event()
-    file_watch = threading.Thread(target=watch_for_file_change, args=(file_change, doc.filename))
-    file_watch.daemon = True
-    file_watch.start()
+    watcher.start()
+    for d in bufs.docs:
+        watcher.watch(d.filename)
+
+    state_store.start_autosave()
 
-    doc_viewer = threading.Thread(target=view, args=(file_change, doc))
+    doc_viewer = threading.Thread(target=view, args=(watcher.event, doc))
     doc_viewer.start()
 
 if __name__ == '__main__':